@@ -2,6 +2,12 @@
 
 import streamlit as st
 import os
+import shutil
+import hashlib
+import tempfile
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from rag_system import DociaRAG
 from docia_agent_gemini import DociaAgentGemini
@@ -19,6 +25,19 @@ except ImportError:
     PDF_EXPORT_AVAILABLE = False
     print("⚠️ Utilidades de exportación no disponibles")
 
+# Etiquetas de los campos de datos clínicos (mismo orden que los widgets)
+_CLINICAL_LABELS = ("Edad/sexo", "Síntomas", "Signos vitales",
+                    "Antecedentes", "Medicación", "Hallazgos")
+
+# Opciones de widgets a nivel de módulo: no se re-alocan en cada rerun
+AVAILABLE_USERS = ("Dianik", "Denis", "Estudiante 1", "Estudiante 2", "Nuevo usuario...")
+_USER_INDEX = {u: i for i, u in enumerate(AVAILABLE_USERS)}
+USER_LEVELS = ("estudiante", "interno", "residente")
+MODES = ("chat", "ecg")
+SEARCH_SCOPES = ("Todos los documentos", "Solo mis documentos")
+SPECIALTIES = ("cardiologia", "neumologia", "neurologia", "general")
+DOC_TYPES = ("guideline", "textbook", "paper", "notes")
+
 # Configuración de página
 st.set_page_config(
     page_title="Doc.ia - Asistente Médico",
@@ -33,7 +52,7 @@ load_dotenv()
 # Inicializar sistema (con cache para no recargar cada vez)
 @st.cache_resource
 def init_system():
-    rag = DociaRAG(persist_directory="./chroma_db")
+    rag = DociaRAG(persist_directory="./chroma_db", embedding_precision="float16")
     agent = DociaAgentGemini(rag)
     processor = DocumentProcessor()
     
@@ -44,17 +63,63 @@ def init_system():
             corrections_db = CorrectionsDatabase()
         except:
             pass
-    
-    return rag, agent, processor, corrections_db
 
-rag, agent, processor, corrections_db = init_system()
+    # Executor compartido para trabajo pesado (extracción de PDFs, etc.)
+    # sin bloquear el hilo del script de Streamlit
+    executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 2)
+
+    # Calentar el modelo de embeddings y el índice en segundo plano:
+    # la primera búsqueda real no paga el costo de mmap/kernels
+    def _warmup():
+        try:
+            rag.search("warmup", n_results=1)
+        except Exception:
+            pass
+
+    threading.Thread(target=_warmup, daemon=True).start()
+
+    return rag, agent, processor, corrections_db, executor
+
+rag, agent, processor, corrections_db, executor = init_system()
+
+# Cachear consultas de estadísticas (se invalidan al subir documentos)
+@st.cache_data(ttl=30)
+def _cached_stats(user_id):
+    return rag.get_collection_stats(user_id=user_id)
+
+@st.cache_data(ttl=30)
+def _cached_user_docs(user_id):
+    return rag.get_user_documents(user_id)
+
+# Reducir imagen de ECG a máx 1600 px y re-codificar JPEG una sola vez:
+# las fotos de móvil (12 MP) decodificadas en cada rerun consumen mucha
+# RAM y ancho de banda hacia el navegador
+@st.cache_data(show_spinner=False)
+def _prepare_ecg_image(image_bytes):
+    img = Image.open(io.BytesIO(image_bytes))
+    img.thumbnail((1600, 1600), Image.LANCZOS)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    buf = io.BytesIO()
+    img.save(buf, format='JPEG', quality=85, optimize=True)
+    return buf.getvalue()
+
+# Caché de respuestas del agente: consultas repetidas (muy comunes en
+# sesiones de enseñanza) no vuelven a pagar la llamada a Gemini.
+# Es un dict compartido (no st.cache_data) porque la ruta principal
+# ahora hace streaming y solo cachea el texto final.
+@st.cache_resource
+def _response_cache():
+    return {}
+
+_RESPONSE_CACHE_MAX = 256
+_RESPONSE_TTL_S = 3600
 
 # Inicializar session state
-if 'conversation_history' not in st.session_state:
-    st.session_state.conversation_history = {
-        'questions': [],
-        'responses': []
-    }
+# Historial como lista de tuplas (pregunta, respuesta): menos contenedores
+# que dos listas paralelas y se serializa más barato en session_state
+if 'turns' not in st.session_state:
+    st.session_state.turns = []
 
 if 'current_user' not in st.session_state:
     st.session_state.current_user = "Dianik"
@@ -62,44 +127,16 @@ if 'current_user' not in st.session_state:
 if 'uploaded_ecg_image' not in st.session_state:
     st.session_state.uploaded_ecg_image = None
 
-# CSS personalizado
-st.markdown("""
-<style>
-    .main-header {
-        font-size: 3rem;
-        color: #1E88E5;
-        text-align: center;
-        margin-bottom: 2rem;
-    }
-    .stButton>button {
-        width: 100%;
-        background-color: #1E88E5;
-        color: white;
-    }
-    .feedback-section {
-        background-color: #FFF3E0;
-        padding: 1rem;
-        border-radius: 10px;
-        margin-top: 1rem;
-    }
-    .user-badge {
-        background-color: #E3F2FD;
-        padding: 0.5rem 1rem;
-        border-radius: 20px;
-        font-weight: bold;
-        color: #1976D2;
-        text-align: center;
-        margin-bottom: 1rem;
-    }
-    .info-box {
-        background-color: #E8F5E9;
-        padding: 1rem;
-        border-radius: 10px;
-        border-left: 4px solid #4CAF50;
-        margin: 1rem 0;
-    }
-</style>
-""", unsafe_allow_html=True)
+# CSS personalizado (archivo externo, leído una vez con cache_data).
+# El <style> se emite en CADA run: Streamlit descarta los elementos que
+# un rerun no vuelve a emitir, así que condicionarlo dejaba la app sin
+# estilos a partir de la segunda interacción.
+@st.cache_data
+def _load_css():
+    with open(os.path.join(os.path.dirname(__file__), "style.css"), encoding="utf-8") as f:
+        return f.read()
+
+st.markdown(f"<style>{_load_css()}</style>", unsafe_allow_html=True)
 
 # Header
 st.markdown('<h1 class="main-header">🩺 Doc.ia</h1>', unsafe_allow_html=True)
@@ -110,12 +147,10 @@ with st.sidebar:
     # Selector de usuario
     st.header("👤 Usuario")
     
-    available_users = ["Dianik", "Denis", "Estudiante 1", "Estudiante 2", "Nuevo usuario..."]
-    
     selected_user = st.selectbox(
         "¿Quién eres?",
-        available_users,
-        index=available_users.index(st.session_state.current_user) if st.session_state.current_user in available_users else 0
+        AVAILABLE_USERS,
+        index=_USER_INDEX.get(st.session_state.current_user, 0)
     )
     
     if selected_user == "Nuevo usuario...":
@@ -138,21 +173,21 @@ with st.sidebar:
     
     user_level = st.selectbox(
         "Nivel del usuario",
-        ["estudiante", "interno", "residente"],
+        USER_LEVELS,
         index=0
     )
-    
+
     mode = st.selectbox(
         "Modo",
-        ["chat", "ecg"],
+        MODES,
         index=0,
         help="Chat: consultas normales | ECG: análisis de electrocardiogramas"
     )
-    
+
     # Filtro de búsqueda
     search_scope = st.radio(
         "Buscar en:",
-        ["Todos los documentos", "Solo mis documentos"],
+        SEARCH_SCOPES,
         index=0,
         help="Limitar búsqueda a documentos que tú subiste"
     )
@@ -222,81 +257,121 @@ with st.sidebar:
         help="Documentos médicos (guías, papers, etc.)"
     )
     
+    # Saltar todo el pipeline si el archivo ya fue indexado
+    content_digest = None
+    if uploaded_file:
+        content_digest = hashlib.sha256(uploaded_file.getbuffer()).hexdigest()
+        if rag.has_document(content_digest):
+            st.info("📑 Este documento ya está indexado — no se vuelve a procesar")
+            uploaded_file = None
+
     if uploaded_file:
         with st.spinner("📄 Procesando documento..."):
-            temp_path = f"./temp_{uploaded_file.name}"
-            with open(temp_path, "wb") as f:
-                f.write(uploaded_file.getbuffer())
-            
             try:
-                if uploaded_file.name.endswith('.pdf'):
-                    doc_data = processor.extract_from_pdf(temp_path)
-                else:
-                    doc_data = processor.extract_from_ppt(temp_path)
+                # Temporal con nombre único (sin colisiones entre subidas
+                # concurrentes) en tmpfs si está disponible; copiado en
+                # streaming (buffer de 1 MiB) para no materializar todo
+                # el archivo en memoria
+                uploaded_file.seek(0)
+                with tempfile.NamedTemporaryFile(
+                    delete=False,
+                    dir="/dev/shm" if os.path.isdir("/dev/shm") else None,
+                    suffix=os.path.splitext(uploaded_file.name)[1]
+                ) as tmp:
+                    shutil.copyfileobj(uploaded_file, tmp, length=1 << 20)
+                    temp_path = tmp.name
+
+                try:
+                    # Extraer en el executor para no bloquear el hilo del script
+                    if uploaded_file.name.endswith('.pdf'):
+                        fut = executor.submit(processor.extract_from_pdf, temp_path)
+                    else:
+                        fut = executor.submit(processor.extract_from_ppt, temp_path)
+
+                    with st.status("📄 Extrayendo texto del documento...") as status:
+                        while not fut.done():
+                            time.sleep(0.2)
+                        doc_data = fut.result()
+                        status.update(label="✅ Texto extraído", state="complete")
+                finally:
+                    # El temporal solo se necesita durante la extracción
+                    os.unlink(temp_path)
                 
                 st.subheader("Metadatos del documento")
                 title = st.text_input("Título", value=doc_data['metadata'].get('title', ''))
-                specialty = st.selectbox("Especialidad", ["cardiologia", "neumologia", "neurologia", "general"])
+                specialty = st.selectbox("Especialidad", SPECIALTIES)
                 year = st.number_input("Año", min_value=2000, max_value=2025, value=2024)
-                doc_type = st.selectbox("Tipo", ["guideline", "textbook", "paper", "notes"])
+                doc_type = st.selectbox("Tipo", DOC_TYPES)
                 
                 if st.button("💾 Guardar en base de datos"):
                     metadata = {
                         "title": title,
                         "specialty": specialty,
                         "year": year,
-                        "type": doc_type
+                        "type": doc_type,
+                        "content_hash": content_digest
                     }
                     
-                    # NUEVO: Guardar con usuario
+                    # NUEVO: Guardar con usuario (embeddings en batch + barra de progreso)
+                    ingest_bar = st.progress(0.0, text="Indexando documento...")
                     doc_id = rag.add_document(
-                        doc_data, 
+                        doc_data,
                         metadata,
-                        uploaded_by=st.session_state.current_user
+                        uploaded_by=st.session_state.current_user,
+                        embed_batch_size=64,
+                        progress_callback=lambda frac: ingest_bar.progress(frac)
                     )
+                    ingest_bar.progress(1.0, text="Documento indexado")
                     
+                    # Invalidar cachés: el corpus cambió, las respuestas
+                    # anteriores podrían recuperar otras fuentes
+                    _cached_stats.clear()
+                    _cached_user_docs.clear()
+                    _response_cache().clear()
+
                     st.success(f"✅ Documento '{title}' cargado con éxito!")
                     st.info(f"📊 {len(doc_data['chunks'])} fragmentos indexados")
                     st.info(f"👤 Subido por: {st.session_state.current_user}")
                     
-                    os.remove(temp_path)
                     st.rerun()
-                    
+
             except Exception as e:
                 st.error(f"❌ Error al procesar: {str(e)}")
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
     
     st.divider()
-    
-    # Estadísticas
-    st.header("📊 Estadísticas")
-    
+
+    # Estadísticas (fragment: interactuar aquí no re-ejecuta todo el script)
+    @st.fragment
+    def _stats_section(stats_user_id, global_view):
+        st.header("📊 Estadísticas")
+
+        stats = _cached_stats(stats_user_id)
+
+        st.metric("Total chunks", stats['total_chunks'])
+        st.metric("Documentos únicos", stats['unique_docs'])
+
+        # Mostrar distribución por usuario (solo si es vista global)
+        if global_view and stats.get('by_user'):
+            with st.expander("Por usuario"):
+                for user, count in stats['by_user'].items():
+                    st.write(f"**{user}:** {count} chunks")
+
+        # NUEVO: Mostrar mis documentos
+        if st.button("📄 Ver mis documentos"):
+            my_docs = _cached_user_docs(st.session_state.current_user)
+            if my_docs:
+                st.write(f"**Tus documentos ({len(my_docs)}):**")
+                for doc in my_docs:
+                    with st.expander(f"{doc['title']} ({doc['year']})"):
+                        st.write(f"**Tipo:** {doc['type']}")
+                        st.write(f"**Especialidad:** {doc['specialty']}")
+                        st.write(f"**Fecha subida:** {doc['upload_date'][:10]}")
+            else:
+                st.info("No has subido documentos aún")
+
     # Determinar user_id para stats
     stats_user_id = st.session_state.current_user if search_scope == "Solo mis documentos" else None
-    stats = rag.get_collection_stats(user_id=stats_user_id)
-    
-    st.metric("Total chunks", stats['total_chunks'])
-    st.metric("Documentos únicos", stats['unique_docs'])
-    
-    # Mostrar distribución por usuario (solo si es vista global)
-    if search_scope == "Todos los documentos" and stats.get('by_user'):
-        with st.expander("Por usuario"):
-            for user, count in stats['by_user'].items():
-                st.write(f"**{user}:** {count} chunks")
-    
-    # NUEVO: Mostrar mis documentos
-    if st.button("📄 Ver mis documentos"):
-        my_docs = rag.get_user_documents(st.session_state.current_user)
-        if my_docs:
-            st.write(f"**Tus documentos ({len(my_docs)}):**")
-            for doc in my_docs:
-                with st.expander(f"{doc['title']} ({doc['year']})"):
-                    st.write(f"**Tipo:** {doc['type']}")
-                    st.write(f"**Especialidad:** {doc['specialty']}")
-                    st.write(f"**Fecha subida:** {doc['upload_date'][:10]}")
-        else:
-            st.info("No has subido documentos aún")
+    _stats_section(stats_user_id, search_scope == "Todos los documentos")
 
 # Main chat area
 st.header("💬 Consulta médica")
@@ -312,10 +387,10 @@ if mode == "ecg":
     )
     
     if ecg_image:
-        # Mostrar imagen
-        image = Image.open(ecg_image)
-        st.image(image, caption="ECG subido", use_container_width=True)
-        st.session_state.uploaded_ecg_image = ecg_image
+        # Mostrar versión reducida (bytes cacheados, no se re-decodifica por rerun)
+        ecg_bytes = _prepare_ecg_image(ecg_image.getvalue())
+        st.image(ecg_bytes, caption="ECG subido", use_container_width=True)
+        st.session_state.uploaded_ecg_image = ecg_bytes
         st.success("✅ Imagen cargada. Describe los hallazgos del ECG en el campo de texto abajo.")
 
 # Área de datos clínicos
@@ -346,74 +421,164 @@ with col1:
     consultar_btn = st.button("🔍 Consultar", type="primary")
 
 with col2:
-    if PDF_EXPORT_AVAILABLE and len(st.session_state.conversation_history['questions']) > 0:
+    if PDF_EXPORT_AVAILABLE and len(st.session_state.turns) > 0:
+        # El PDF se genera en el executor (no bloquea la UI) y se cachea
+        # por contenido: re-exportar la misma conversación es gratis
+        turns_key = hash(tuple(st.session_state.turns))
+
         if st.button("📄 Exportar a PDF"):
-            try:
+            export = st.session_state.get('pdf_export')
+            if not export or export[0] != turns_key:
                 exporter = ConversationPDFExporter()
-                pdf_bytes = exporter.export_conversation(
-                    questions=st.session_state.conversation_history['questions'],
-                    responses=st.session_state.conversation_history['responses'],
+                fut = executor.submit(
+                    exporter.export_conversation,
+                    questions=[t[0] for t in st.session_state.turns],
+                    responses=[t[1] for t in st.session_state.turns],
                     user_level=user_level,
                     mode=mode,
                     username=st.session_state.current_user
                 )
-                
+                st.session_state.pdf_export = (turns_key, fut)
+
+        export = st.session_state.get('pdf_export')
+        if export and export[0] == turns_key:
+            payload = export[1]
+
+            if not isinstance(payload, bytes):
+                if payload.done():
+                    try:
+                        payload = payload.result()
+                        st.session_state.pdf_export = (turns_key, payload)
+                    except Exception as e:
+                        st.error(f"Error al exportar: {str(e)}")
+                        st.session_state.pdf_export = None
+                        payload = None
+                else:
+                    st.caption("⏳ Generando PDF...")
+                    payload = None
+
+            if isinstance(payload, bytes):
                 st.download_button(
                     label="💾 Descargar PDF",
-                    data=pdf_bytes,
+                    data=payload,
                     file_name=f"docia_conversacion_{datetime.now().strftime('%Y%m%d_%H%M')}.pdf",
                     mime="application/pdf"
                 )
-                
-            except Exception as e:
-                st.error(f"Error al exportar: {str(e)}")
+
+# Sección de feedback de instructora como fragment: los widgets de
+# corrección solo re-ejecutan este bloque, no la consulta completa
+@st.fragment
+def _feedback_section(user_question, result, clinical_data, user_level, mode, user_filter):
+    st.markdown("---")
+    st.markdown('<div class="feedback-section">', unsafe_allow_html=True)
+    st.markdown("### 👩‍⚕️ Feedback de Instructora")
+
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        feedback_text = st.text_area(
+            "Corrección (si es necesaria):",
+            placeholder="Si la respuesta tiene errores, escribe aquí la versión correcta...",
+            height=150,
+            key="feedback_input"
+        )
+    with col2:
+        feedback_type = st.radio(
+            "Evaluación",
+            ["✅ Correcta", "⚠️ Mejorable", "❌ Incorrecta"],
+            key="feedback_type"
+        )
+
+    if st.button("💾 Guardar feedback"):
+        # Guardar en BD de correcciones
+        if corrections_db and feedback_text:
+            corrections_db.add_correction(
+                user_question=user_question,
+                original_response=result['response'],
+                correction=feedback_text,
+                instructor=st.session_state.current_user,
+                user_level=user_level,
+                feedback_type=feedback_type.split()[1]  # Quitar emoji
+            )
+
+        st.success("✅ Feedback guardado para entrenamiento")
+
+        # Si es incorrecta, aplicar modo entrenamiento
+        if feedback_text and feedback_type == "❌ Incorrecta":
+            with st.spinner("🧠 Aplicando modo entrenamiento..."):
+                training_result = agent.generate_response(
+                    user_question=user_question,
+                    user_level=user_level,
+                    mode=mode,
+                    clinical_data=clinical_data,
+                    user_filter=user_filter,
+                    feedback={
+                        'original': result['response'],
+                        'correction': feedback_text
+                    }
+                )
+
+                st.markdown("### 📝 Versión corregida + Aprendizaje")
+                st.markdown(training_result['response'])
+
+    st.markdown('</div>', unsafe_allow_html=True)
 
 # Procesar consulta
 if consultar_btn:
     if not user_question:
         st.warning("⚠️ Por favor escribe una consulta")
     else:
-        # Preparar datos clínicos
-        clinical_data = {
-            "Edad/sexo": edad_sexo,
-            "Síntomas": sintomas,
-            "Signos vitales": signos_vitales,
-            "Antecedentes": antecedentes,
-            "Medicación": medicacion,
-            "Hallazgos": hallazgos
-        } if any([edad_sexo, sintomas, signos_vitales, antecedentes, medicacion, hallazgos]) else None
+        # Preparar datos clínicos (tupla: sin alocar lista por rerun)
+        clinical_fields = (edad_sexo, sintomas, signos_vitales,
+                           antecedentes, medicacion, hallazgos)
+        clinical_data = dict(zip(_CLINICAL_LABELS, clinical_fields)) if any(clinical_fields) else None
         
         # Generar respuesta
         with st.spinner("🤔 Doc.ia está analizando..."):
             try:
-                # NUEVO: Determinar filtro de usuario
+                # Determinar filtro de usuario
                 user_filter = st.session_state.current_user if search_scope == "Solo mis documentos" else None
-                
-                # Modificar temporalmente el método search del agente
-                original_search = agent.rag.search
-                
-                def filtered_search(query, n_results=5):
-                    return original_search(query, n_results=n_results, user_id=user_filter)
-                
-                agent.rag.search = filtered_search
-                
-                result = agent.generate_response(
-                    user_question=user_question,
-                    user_level=user_level,
-                    mode=mode,
-                    clinical_data=clinical_data
-                )
-                
-                # Restaurar método original
-                agent.rag.search = original_search
-                
-                # Guardar en historial
-                st.session_state.conversation_history['questions'].append(user_question)
-                st.session_state.conversation_history['responses'].append(result['response'])
-                
-                # Mostrar respuesta
+
+                # Clave hashable para la caché de respuestas
+                clinical_tuple = tuple(clinical_data.items()) if clinical_data else None
+                cache = _response_cache()
+                cache_key = (user_question, user_level, mode, clinical_tuple, user_filter)
+
                 st.markdown("### 🩺 Respuesta de Doc.ia")
-                st.markdown(result['response'])
+
+                cached_entry = cache.get(cache_key)
+                if cached_entry is not None and time.time() - cached_entry[0] >= _RESPONSE_TTL_S:
+                    del cache[cache_key]
+                    cached_entry = None
+
+                if cached_entry is not None:
+                    # Repetida: mostrar el texto cacheado sin llamar a Gemini
+                    result = cached_entry[1]
+                    st.markdown(result['response'])
+                else:
+                    # Streaming: los tokens se pintan según llegan de Gemini
+                    sources, stream = agent.generate_response_stream(
+                        user_question=user_question,
+                        user_level=user_level,
+                        mode=mode,
+                        clinical_data=clinical_data,
+                        user_filter=user_filter
+                    )
+                    full_response = st.write_stream(stream)
+
+                    result = {
+                        "response": full_response,
+                        "sources_used": len(sources),
+                        "sources": sources
+                    }
+
+                    # Solo se llega aquí si el stream terminó sin excepción:
+                    # los fallos de Gemini propagan y nunca se cachean
+                    if len(cache) >= _RESPONSE_CACHE_MAX:
+                        cache.pop(next(iter(cache)))
+                    cache[cache_key] = (time.time(), result)
+
+                # Guardar en historial
+                st.session_state.turns.append((user_question, result['response']))
                 
                 # Mostrar fuentes
                 if result['sources_used'] > 0:
@@ -428,59 +593,11 @@ if consultar_btn:
 - **Subido por:** {meta.get('uploaded_by', 'desconocido')}
                             """)
                 
-                # Modo instructora: feedback
+                # Modo instructora: feedback (fragment: escribir la corrección
+                # no re-ejecuta la consulta a Gemini ni el resto del script)
                 if is_instructor:
-                    st.markdown("---")
-                    st.markdown('<div class="feedback-section">', unsafe_allow_html=True)
-                    st.markdown("### 👩‍⚕️ Feedback de Instructora")
-                    
-                    col1, col2 = st.columns([3, 1])
-                    with col1:
-                        feedback_text = st.text_area(
-                            "Corrección (si es necesaria):",
-                            placeholder="Si la respuesta tiene errores, escribe aquí la versión correcta...",
-                            height=150,
-                            key="feedback_input"
-                        )
-                    with col2:
-                        feedback_type = st.radio(
-                            "Evaluación",
-                            ["✅ Correcta", "⚠️ Mejorable", "❌ Incorrecta"],
-                            key="feedback_type"
-                        )
-                    
-                    if st.button("💾 Guardar feedback"):
-                        # Guardar en BD de correcciones
-                        if corrections_db and feedback_text:
-                            corrections_db.add_correction(
-                                user_question=user_question,
-                                original_response=result['response'],
-                                correction=feedback_text,
-                                instructor=st.session_state.current_user,
-                                user_level=user_level,
-                                feedback_type=feedback_type.split()[1]  # Quitar emoji
-                            )
-                        
-                        st.success("✅ Feedback guardado para entrenamiento")
-                        
-                        # Si es incorrecta, aplicar modo entrenamiento
-                        if feedback_text and feedback_type == "❌ Incorrecta":
-                            with st.spinner("🧠 Aplicando modo entrenamiento..."):
-                                training_result = agent.generate_response(
-                                    user_question=user_question,
-                                    user_level=user_level,
-                                    mode=mode,
-                                    clinical_data=clinical_data,
-                                    feedback={
-                                        'original': result['response'],
-                                        'correction': feedback_text
-                                    }
-                                )
-                                
-                                st.markdown("### 📝 Versión corregida + Aprendizaje")
-                                st.markdown(training_result['response'])
-                    
-                    st.markdown('</div>', unsafe_allow_html=True)
+                    _feedback_section(user_question, result, clinical_data,
+                                      user_level, mode, user_filter)
                 
             except Exception as e:
                 st.error(f"❌ Error: {str(e)}")
@@ -2,24 +2,45 @@
 
 import google.generativeai as genai
 import os
+import time
 from typing import List, Dict, Optional
 
-class DociaAgentGemini:
-    def __init__(self, rag_system):
-        # Configurar Gemini
+# Separador visual usado en todos los bloques del prompt
+_SEP = "━" * 36
+
+# Clientes GenerativeModel compartidos a nivel de módulo: cada instancia
+# mantiene su canal HTTP/gRPC, así que reutilizarla entre agentes evita
+# pagar handshake TCP+TLS por cliente nuevo
+_MODEL_CACHE: Dict[tuple, "genai.GenerativeModel"] = {}
+_CONFIGURED = False
+
+def _get_model(model_name: str, system_instruction: str = None) -> "genai.GenerativeModel":
+    """Devuelve un GenerativeModel compartido (lo crea una sola vez)"""
+    global _CONFIGURED
+
+    if not _CONFIGURED:
         api_key = os.getenv("GOOGLE_API_KEY")
-        
+
         if not api_key:
             raise ValueError("❌ GOOGLE_API_KEY no encontrada en archivo .env")
-        
+
         genai.configure(api_key=api_key)
-        
-        # Modelo CORRECTO (Gemini 2.5 Flash)
-        self.model = genai.GenerativeModel('models/gemini-2.5-flash')
-        self.rag = rag_system
-        
-        # System prompt (sin cambios)
-        self.system_prompt = """
+        _CONFIGURED = True
+
+    cache_key = (model_name, system_instruction)
+    model = _MODEL_CACHE.get(cache_key)
+    if model is None:
+        if system_instruction:
+            model = genai.GenerativeModel(model_name, system_instruction=system_instruction)
+        else:
+            model = genai.GenerativeModel(model_name)
+        _MODEL_CACHE[cache_key] = model
+
+    return model
+
+# System prompt a nivel de módulo: una sola string interneada por proceso,
+# compartida por todas las instancias del agente
+SYSTEM_PROMPT = """
 Eres Doc.ia, un asistente clínico-educativo especializado inicialmente en cardiología. 
 Tu propósito es ayudar a estudiantes y profesionales a aprender y razonar de forma segura. 
 No reemplazas a un médico, no das diagnóstico definitivo y no prescribes tratamiento. 
@@ -77,20 +98,81 @@ Si recibes FEEDBACK de la instructora:
 * "Checklist para no repetir el error" (3 bullets)
 * NUNCA discutas con la instructora: su corrección es la verdad del sistema.
 """
-    
+
+class DociaAgentGemini:
+    def __init__(self, rag_system, model_name: str = 'models/gemini-2.5-flash'):
+        # Modelo Gemini (compartido entre instancias con el mismo nombre)
+        self.model_name = model_name
+        self.model = _get_model(model_name)
+        self.rag = rag_system
+        self.system_prompt = SYSTEM_PROMPT
+
+        # Context caching de Gemini: subir el system prompt una vez y
+        # referenciarlo por handle, en vez de re-enviarlo (y re-procesar
+        # su prefill) en cada llamada. Si la API no lo permite (p.ej. el
+        # prompt no llega al mínimo de tokens de caching, SDK antiguo),
+        # se sigue mandando inline como siempre.
+        # _system_in_model: el prompt ya viaja con el modelo (caching O
+        # system_instruction); _using_context_cache: solo la variante con
+        # CachedContent, la única con TTL que haya que renovar.
+        self._system_in_model = False
+        self._using_context_cache = False
+        self._cache_created = 0.0
+        self._init_context_cache()
+
+    # TTL del cache de contexto (se renueva un poco antes de expirar)
+    _CACHE_TTL_S = 3600
+    _CACHE_REFRESH_S = 3300
+
+    def _init_context_cache(self):
+        """Intenta crear el CachedContent con el system prompt"""
+        try:
+            cached = genai.caching.CachedContent.create(
+                model=self.model_name,
+                system_instruction=self.system_prompt,
+                ttl=f"{self._CACHE_TTL_S}s"
+            )
+            self.model = genai.GenerativeModel.from_cached_content(cached)
+            self._system_in_model = True
+            self._using_context_cache = True
+            self._cache_created = time.time()
+            print("✅ System prompt cacheado en Gemini (context caching)")
+        except Exception as e:
+            print(f"⚠️ Context caching no disponible: {e}")
+            # Plan B: fijar el system prompt como system_instruction del
+            # modelo. No ahorra prefill en el servidor como el caching,
+            # pero evita re-interpolar ~3 KB de prompt en cada request.
+            # Sin TTL que renovar: no se reintenta el caching por request.
+            self._using_context_cache = False
+            try:
+                self.model = _get_model(
+                    self.model_name,
+                    system_instruction=self.system_prompt
+                )
+                self._system_in_model = True
+                print("✅ System prompt fijado como system_instruction del modelo")
+            except Exception as e2:
+                self._system_in_model = False
+                print(f"⚠️ system_instruction no soportado, system prompt inline: {e2}")
+
+    def _refresh_context_cache(self):
+        """Renueva el handle del cache antes de que expire el TTL"""
+        if self._using_context_cache and time.time() - self._cache_created > self._CACHE_REFRESH_S:
+            self._init_context_cache()
+
     def format_sources(self, sources: List[Dict]) -> str:
-        """Formatea fuentes para el prompt"""
+        """Formatea fuentes para el prompt (O(n): lista + join, sin += de str)"""
         if not sources:
             return "SOURCES: No se encontraron documentos subidos relevantes para esta consulta."
-        
-        formatted = "SOURCES recuperadas de la base de datos:\n\n"
-        
+
+        parts = ["SOURCES recuperadas de la base de datos:\n\n"]
+
         for i, source in enumerate(sources, 1):
             meta = source['metadata']
-            formatted += f"""
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+            parts.append(f"""
+{_SEP}
 FUENTE {i}/{len(sources)} — Relevancia: {source['relevance_score']}/10
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+{_SEP}
 Documento: {meta['title']}
 Sección: {meta['section']}
 Página: {meta['page']}
@@ -98,55 +180,53 @@ Año: {meta.get('year', 'N/A')}
 
 CONTENIDO:
 {source['text']}
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+{_SEP}
 
-"""
-        return formatted
+""")
+        return ''.join(parts)
     
-    def generate_response(
+    def _build_prompt(
         self,
         user_question: str,
-        user_level: str = "estudiante",
-        mode: str = "chat",
+        user_level: str,
+        mode: str,
+        sources: List[Dict],
         clinical_data: Optional[Dict] = None,
         feedback: Optional[Dict] = None
-    ) -> Dict:
-        """Genera respuesta con RAG + Gemini"""
-        
-        # 1. Buscar en RAG
-        sources = self.rag.search(
-            query=user_question,
-            n_results=5
-        )
-        
-        # 2. Construir prompt completo
-        full_prompt = f"""{self.system_prompt}
+    ) -> str:
+        """Construye el prompt completo (compartido por las rutas normal y streaming)
 
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+        Si el system prompt está cacheado en Gemini, solo se envía el
+        bloque dinámico (config + fuentes + consulta).
+        """
+        system_block = "" if self._system_in_model else self.system_prompt
+
+        parts = [f"""{system_block}
+
+{_SEP}
 CONFIGURACIÓN:
 - USER_LEVEL: {user_level}
 - MODE: {mode}
 - LANG: es
 
 {self.format_sources(sources)}
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+{_SEP}
 
 CONSULTA DEL USUARIO:
 {user_question}
-"""
-        
+"""]
+
         if clinical_data:
-            full_prompt += "\n\nDATOS CLÍNICOS PROPORCIONADOS:\n"
-            for key, value in clinical_data.items():
-                if value:
-                    full_prompt += f"* {key}: {value}\n"
-        
+            parts.append("\n\nDATOS CLÍNICOS PROPORCIONADOS:\n")
+            parts.extend(f"* {key}: {value}\n"
+                         for key, value in clinical_data.items() if value)
+
         if feedback:
-            full_prompt += f"""
+            parts.append(f"""
 
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+{_SEP}
 FEEDBACK DE LA INSTRUCTORA:
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+{_SEP}
 
 Tu respuesta original fue:
 {feedback['original']}
@@ -155,8 +235,39 @@ La corrección de la instructora es:
 {feedback['correction']}
 
 APLICA EL MODO ENTRENAMIENTO: genera la versión corregida, qué aprendiste, y un checklist.
-"""
-        
+""")
+
+        return ''.join(parts)
+
+    def generate_response(
+        self,
+        user_question: str,
+        user_level: str = "estudiante",
+        mode: str = "chat",
+        clinical_data: Optional[Dict] = None,
+        feedback: Optional[Dict] = None,
+        user_filter: Optional[str] = None
+    ) -> Dict:
+        """Genera respuesta con RAG + Gemini
+
+        Args:
+            user_filter: limitar búsqueda a documentos de este usuario (None = todos)
+        """
+        self._refresh_context_cache()
+
+        # 1. Buscar en RAG
+        sources = self.rag.search(
+            query=user_question,
+            n_results=5,
+            user_id=user_filter
+        )
+
+        # 2. Construir prompt completo
+        full_prompt = self._build_prompt(
+            user_question, user_level, mode, sources,
+            clinical_data=clinical_data, feedback=feedback
+        )
+
         # 3. Llamar a Gemini
         try:
             response = self.model.generate_content(
@@ -172,7 +283,7 @@ APLICA EL MODO ENTRENAMIENTO: genera la versión corregida, qué aprendiste, y u
                 "response": response.text,
                 "sources_used": len(sources),
                 "sources": sources,
-                "model": "gemini-2.5-flash",
+                "model": self.model_name.split("/")[-1],
                 "cost": "$0.00 (gratis)"
             }
             
@@ -183,6 +294,65 @@ APLICA EL MODO ENTRENAMIENTO: genera la versión corregida, qué aprendiste, y u
                 "response": f"❌ Error al generar respuesta:\n\n{error_msg}\n\n**Soluciones:**\n1. Verifica que tu API key sea válida en https://aistudio.google.com\n2. Asegúrate de que el archivo .env tenga: GOOGLE_API_KEY=\"tu_key\"\n3. Reinicia Streamlit después de cambiar la key",
                 "sources_used": 0,
                 "sources": [],
-                "model": "gemini-2.5-flash",
+                "model": self.model_name.split("/")[-1],
                 "cost": "$0.00"
-            }
\ No newline at end of file
+            }
+
+    def generate_response_stream(
+        self,
+        user_question: str,
+        user_level: str = "estudiante",
+        mode: str = "chat",
+        clinical_data: Optional[Dict] = None,
+        user_filter: Optional[str] = None
+    ):
+        """Versión streaming: devuelve (sources, generador de texto)
+
+        El generador emite los fragmentos a medida que llegan de Gemini,
+        para usar con st.write_stream. La ruta de entrenamiento sigue
+        usando generate_response (necesita la respuesta completa).
+        """
+        self._refresh_context_cache()
+
+        sources = self.rag.search(
+            query=user_question,
+            n_results=5,
+            user_id=user_filter
+        )
+
+        full_prompt = self._build_prompt(
+            user_question, user_level, mode, sources,
+            clinical_data=clinical_data
+        )
+
+        def _stream(min_chunk_chars=24):
+            # Coalescer: agrupar fragmentos diminutos antes de emitirlos
+            # (menos mensajes hacia el navegador, misma sensación de tipeo)
+            buffer = ""
+            try:
+                response = self.model.generate_content(
+                    full_prompt,
+                    stream=True,
+                    generation_config=genai.GenerationConfig(
+                        temperature=0.1,
+                        top_p=0.9,
+                        max_output_tokens=2048
+                    )
+                )
+                for chunk in response:
+                    if chunk.text:
+                        buffer += chunk.text
+                        if len(buffer) >= min_chunk_chars:
+                            yield buffer
+                            buffer = ""
+                if buffer:
+                    yield buffer
+            except Exception:
+                # Volcar lo que haya llegado y propagar: el caller debe
+                # poder distinguir un fallo de una respuesta real (p.ej.
+                # para no cachear el error como si fuera la respuesta)
+                if buffer:
+                    yield buffer
+                raise
+
+        return sources, _stream()
\ No newline at end of file
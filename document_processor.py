@@ -1,20 +1,63 @@
 # document_processor.py
 
-import fitz  # PyMuPDF
-from pptx import Presentation
+import os
 import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from typing import List, Dict
-import tiktoken
+
+# fitz (PyMuPDF), pptx y tiktoken se importan perezosamente en el punto
+# de uso: importarlos aquí penaliza cada cold-start de Streamlit aunque
+# la sesión nunca procese un documento
+
+# A partir de cuántas páginas vale la pena repartir la extracción en procesos
+_PARALLEL_PAGE_THRESHOLD = 16
+_PAGES_PER_WORKER_TASK = 8
+
+# Regexes de limpieza precompiladas (se ejecutan una vez por página/slide)
+_MULTISPACE = re.compile(r' +')
+_MULTINEWLINE = re.compile(r'\n{3,}')
+
+@lru_cache(maxsize=1)
+def _get_encoder():
+    """Tokenizer compartido (uno por proceso, también en los workers)"""
+    import tiktoken
+    return tiktoken.get_encoding("cl100k_base")
+
+def _extract_page_range(pdf_path: str, start: int, end: int) -> List[Dict]:
+    """Worker de proceso: extrae y trocea un rango de páginas de un PDF
+
+    Es una función a nivel de módulo (picklable) y abre el PDF dentro del
+    worker para no serializar el fitz.Document.
+    """
+    import fitz
+
+    processor = DocumentProcessor()
+    doc = fitz.open(pdf_path)
+    chunks = []
+
+    try:
+        for page_num in range(start, min(end, len(doc))):
+            paragraphs = processor._page_paragraphs(doc[page_num])
+
+            if not paragraphs:
+                continue
+
+            chunks.extend(processor._pack_paragraphs(paragraphs, page_num + 1))
+    finally:
+        doc.close()
+
+    return chunks
 
 class DocumentProcessor:
     """
     Procesa documentos médicos (PDF y PPT) y los convierte en chunks
     listos para indexar en el sistema RAG
     """
-    
+
     def __init__(self):
         # Tokenizer para contar tokens (compatible con GPT/Claude/Gemini)
-        self.encoder = tiktoken.get_encoding("cl100k_base")
+        self.encoder = _get_encoder()
     
     def count_tokens(self, text: str) -> int:
         """Cuenta tokens en un texto"""
@@ -30,8 +73,10 @@ class DocumentProcessor:
         Returns:
             dict con 'metadata' y 'chunks'
         """
+        import fitz  # PyMuPDF
+
         print(f"📄 Abriendo PDF: {pdf_path}")
-        
+
         try:
             doc = fitz.open(pdf_path)
         except Exception as e:
@@ -49,33 +94,63 @@ class DocumentProcessor:
         
         print(f"📖 Título detectado: {metadata['title']}")
         print(f"📄 Total páginas: {len(doc)}")
-        
-        # Procesar cada página
-        for page_num in range(len(doc)):
-            page = doc[page_num]
-            text = page.get_text("text")
-            
-            # Limpiar texto
-            text = self._clean_text(text)
-            
-            if not text.strip():
+
+        n_pages = len(doc)
+        doc.close()
+
+        # PDFs grandes: repartir rangos de páginas entre procesos
+        # (la extracción de PyMuPDF es C CPU-bound, escala casi lineal)
+        n_workers = os.cpu_count() or 1
+        if n_pages >= _PARALLEL_PAGE_THRESHOLD and n_workers > 1:
+            try:
+                chunks = self._extract_pdf_parallel(pdf_path, n_pages, n_workers)
+                print(f"✅ PDF procesado en paralelo: {len(chunks)} chunks extraídos")
+                return {"metadata": metadata, "chunks": chunks}
+            except Exception as e:
+                print(f"⚠️ Extracción paralela falló ({e}), usando modo serial")
+
+        # Procesar cada página (modo serial)
+        doc = fitz.open(pdf_path)
+
+        for page_num in range(n_pages):
+            paragraphs = self._page_paragraphs(doc[page_num])
+
+            if not paragraphs:
                 continue
-            
+
             # Dividir en chunks si es necesario
-            sections = self._split_by_sections(text, page_num + 1)
+            sections = self._pack_paragraphs(paragraphs, page_num + 1)
             chunks.extend(sections)
-            
+
             if (page_num + 1) % 10 == 0:
                 print(f"  ✓ Procesadas {page_num + 1} páginas...")
-        
+
         print(f"✅ PDF procesado: {len(chunks)} chunks extraídos")
-        
+
         doc.close()
-        
+
         return {
             "metadata": metadata,
             "chunks": chunks
         }
+
+    def _extract_pdf_parallel(self, pdf_path: str, n_pages: int, n_workers: int) -> List[Dict]:
+        """Extrae páginas en rangos repartidos en un pool de procesos"""
+        ranges = [(start, start + _PAGES_PER_WORKER_TASK)
+                  for start in range(0, n_pages, _PAGES_PER_WORKER_TASK)]
+
+        chunks = []
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            # map preserva el orden de los rangos => orden de páginas
+            for range_chunks in pool.map(
+                _extract_page_range,
+                [pdf_path] * len(ranges),
+                [r[0] for r in ranges],
+                [r[1] for r in ranges]
+            ):
+                chunks.extend(range_chunks)
+
+        return chunks
     
     def extract_from_ppt(self, ppt_path: str) -> Dict:
         """
@@ -87,8 +162,10 @@ class DocumentProcessor:
         Returns:
             dict con 'metadata' y 'chunks'
         """
+        from pptx import Presentation
+
         print(f"📊 Abriendo PPT: {ppt_path}")
-        
+
         try:
             prs = Presentation(ppt_path)
         except Exception as e:
@@ -150,73 +227,107 @@ class DocumentProcessor:
         Limpia texto manteniendo estructura médica importante
         """
         # Normalizar espacios múltiples
-        text = re.sub(r' +', ' ', text)
-        
+        text = _MULTISPACE.sub(' ', text)
+
         # Normalizar saltos de línea múltiples
-        text = re.sub(r'\n\n+', '\n\n', text)
-        
+        text = _MULTINEWLINE.sub('\n\n', text)
+
         # Quitar espacios al inicio/final
-        text = text.strip()
-        
-        return text
+        return text.strip()
     
+    def _page_paragraphs(self, page) -> List[str]:
+        """Extrae los párrafos de una página usando los bloques de layout
+        de PyMuPDF (ya segmentados por el motor, sin re-derivarlos del
+        texto plano). Descarta bloques de imagen (block_type != 0).
+        """
+        paragraphs = []
+
+        for block in page.get_text("blocks"):
+            # (x0, y0, x1, y1, texto, block_no, block_type)
+            if block[6] != 0:
+                continue
+
+            block_text = self._clean_text(block[4])
+            if block_text:
+                paragraphs.append(block_text)
+
+        return paragraphs
+
     def _split_by_sections(self, text: str, page_num: int) -> List[Dict]:
         """
-        Divide texto en chunks inteligentes
+        Divide texto plano en chunks (p. ej. slides de PPT): separa por
+        párrafos y delega el empaquetado en _pack_paragraphs
+        """
+        paragraphs = [p.strip() for p in text.split('\n\n') if p.strip()]
+        return self._pack_paragraphs(paragraphs, page_num)
+
+    def _pack_paragraphs(self, paragraphs: List[str], page_num: int) -> List[Dict]:
+        """
+        Empaqueta una lista de párrafos en chunks inteligentes
         Respeta la estructura médica (no corta en medio de una lista, tabla, etc.)
+
+        Cada párrafo se tokeniza UNA sola vez (batch C de tiktoken) y el
+        empaquetado suma conteos precalculados; antes se re-tokenizaba el
+        chunk acumulado en cada iteración (O(n²) en páginas largas).
         """
+        if not paragraphs:
+            return []
+
         # Si es corto, devolver completo
-        if self.count_tokens(text) < 600:
+        text = "\n\n".join(paragraphs)
+        total_tokens = self.count_tokens(text)
+        if total_tokens < 600:
             return [{
                 "text": text,
                 "page": page_num,
                 "section": f"Página {page_num}",
-                "tokens": self.count_tokens(text)
+                "tokens": total_tokens
             }]
-        
-        # Dividir por párrafos
-        paragraphs = [p.strip() for p in text.split('\n\n') if p.strip()]
-        
+
+        # Tokenizar todos los párrafos en una pasada (libera el GIL)
+        para_tokens = [len(t) for t in self.encoder.encode_ordinary_batch(paragraphs)]
+
         chunks = []
-        current_chunk = ""
+        current_paras = []
+        running_tokens = 0
         current_section = f"Página {page_num}"
-        
+
         # Intentar detectar título de sección (línea corta seguida de contenido)
         if paragraphs and len(paragraphs[0]) < 100:
             current_section = paragraphs[0][:100]
-        
-        for para in paragraphs:
-            # Intentar agregar al chunk actual
-            test_chunk = current_chunk + "\n\n" + para if current_chunk else para
-            
-            if self.count_tokens(test_chunk) < 600:
-                current_chunk = test_chunk
-            else:
-                # Guardar chunk actual
-                if current_chunk:
-                    chunks.append({
-                        "text": current_chunk.strip(),
-                        "page": page_num,
-                        "section": current_section,
-                        "tokens": self.count_tokens(current_chunk)
-                    })
-                
+
+        for para, n_tokens in zip(paragraphs, para_tokens):
+            if current_paras and running_tokens + n_tokens >= 600:
+                # Guardar chunk actual (solo aquí se tokeniza el texto final)
+                chunk_text = "\n\n".join(current_paras)
+                chunks.append({
+                    "text": chunk_text,
+                    "page": page_num,
+                    "section": current_section,
+                    "tokens": self.count_tokens(chunk_text)
+                })
+
                 # Empezar nuevo chunk
-                current_chunk = para
-                
+                current_paras = [para]
+                running_tokens = n_tokens
+
                 # Actualizar sección si parece título
                 if len(para) < 100 and not para.endswith('.'):
                     current_section = para[:100]
-        
+            else:
+                current_paras.append(para)
+                running_tokens += n_tokens
+
         # Guardar último chunk
-        if current_chunk:
+        if current_paras:
+            chunk_text = "\n\n".join(current_paras)
             chunks.append({
-                "text": current_chunk.strip(),
+                "text": chunk_text,
                 "page": page_num,
                 "section": current_section,
-                "tokens": self.count_tokens(current_chunk)
+                "tokens": self.count_tokens(chunk_text)
             })
-        
+
         return chunks
     
     def _extract_title(self, doc) -> str:
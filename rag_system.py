@@ -1,27 +1,285 @@
 # rag_system.py
 
-import chromadb
-from chromadb.config import Settings
-from sentence_transformers import SentenceTransformer
+import numpy as np
 from typing import List, Dict, Optional
 from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import hashlib
 import os
+import re
+import queue
+import threading
+import time
+
+# faiss es opcional: si está instalado, las búsquedas globales usan un
+# índice HNSW en memoria (escala logarítmica) en vez del scan de Chroma
+try:
+    import faiss
+    FAISS_AVAILABLE = True
+except ImportError:
+    FAISS_AVAILABLE = False
+
+# Escalera distancia -> score 1-10, vectorizada con searchsorted
+# (side='right' reproduce los umbrales estrictos del if/elif original)
+_SCORE_BINS = np.array([0.4, 0.6, 0.8, 1.0], dtype=np.float32)
+_SCORE_VALUES = np.array([10, 8, 6, 4, 2], dtype=np.int64)
+
+class _OnnxEncoder:
+    """Encoder mpnet sobre ONNX Runtime, compatible con .encode() de
+    sentence-transformers (tokenización + mean pooling en NumPy)
+
+    Se activa apuntando DOCIA_ONNX_MODEL a un .onnx exportado, p.ej.:
+        optimum-cli export onnx --model sentence-transformers/all-mpnet-base-v2 mpnet_onnx/
+    (idealmente cuantizado a int8 con onnxruntime.quantization)
+    """
+
+    MODEL_NAME = 'sentence-transformers/all-mpnet-base-v2'
+
+    def __init__(self, onnx_path: str):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(self.MODEL_NAME)
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = os.cpu_count() or 1
+        self.session = ort.InferenceSession(
+            onnx_path,
+            sess_options=options,
+            providers=['CPUExecutionProvider']
+        )
+
+    def encode(self, texts, batch_size=32, convert_to_numpy=True,
+               show_progress_bar=False, **kwargs):
+        """Misma salida que SentenceTransformer.encode (mean pooling +
+        normalización L2, fp32)"""
+        single = isinstance(texts, str)
+        if single:
+            texts = [texts]
+
+        parts = []
+        for i in range(0, len(texts), batch_size):
+            batch = texts[i:i + batch_size]
+            enc = self.tokenizer(
+                batch,
+                padding=True,
+                truncation=True,
+                max_length=384,
+                return_tensors='np'
+            )
+            hidden = self.session.run(None, {
+                'input_ids': enc['input_ids'].astype(np.int64),
+                'attention_mask': enc['attention_mask'].astype(np.int64)
+            })[0]
+
+            # Mean pooling sobre los tokens válidos
+            mask = enc['attention_mask'][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+            # Normalización L2: el pipeline de all-mpnet-base-v2 termina
+            # en Normalize; sin esto los vectores ONNX tendrían otra
+            # magnitud que los de SentenceTransformer y contaminarían la
+            # caché de embeddings y la colección al cambiar de backend
+            norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+            pooled = pooled / np.clip(norms, 1e-12, None)
+
+            parts.append(pooled.astype(np.float32))
+
+        result = np.concatenate(parts) if parts else np.zeros((0, 768), dtype=np.float32)
+        return result[0] if single else result
+
+# Encoder por proceso worker de la ingesta en lote (inicializado una vez
+# por proceso vía initializer; las funciones son picklables por ser de módulo)
+_BULK_WORKER_MODEL = None
+
+def _bulk_worker_init():
+    """Carga un SentenceTransformer propio en cada proceso del pool"""
+    global _BULK_WORKER_MODEL
+    from sentence_transformers import SentenceTransformer
+    _BULK_WORKER_MODEL = SentenceTransformer('all-mpnet-base-v2', device=_detect_device())
+
+def _bulk_encode_texts(texts: List[str], batch_size: int):
+    """Worker de proceso: codifica los chunks de UN documento"""
+    try:
+        return _BULK_WORKER_MODEL.encode(
+            texts,
+            batch_size=batch_size,
+            convert_to_numpy=True,
+            show_progress_bar=False
+        )
+    except RuntimeError:
+        # OOM: reintentar el documento con la mitad de batch
+        return _BULK_WORKER_MODEL.encode(
+            texts,
+            batch_size=max(batch_size // 2, 1),
+            convert_to_numpy=True,
+            show_progress_bar=False
+        )
+
+def _detect_device() -> str:
+    """Mejor dispositivo disponible para el encoder: cuda > mps > cpu"""
+    try:
+        import torch
+        if torch.cuda.is_available():
+            return 'cuda'
+        if torch.backends.mps.is_available():
+            return 'mps'
+    except Exception:
+        pass
+    return 'cpu'
+
+class _TorchEncoder:
+    """Envoltura fina de SentenceTransformer para acelerar encode():
+    inference_mode siempre (sin autograd), autocast fp16 en CUDA, y
+    batch por defecto de 128 en GPU (vs 32 en CPU) para llenar los SMs
+    """
+
+    def __init__(self, model, device: str):
+        self.model = model
+        self.device = device
+        self.default_batch = 128 if device in ('cuda', 'mps') else 32
+
+    def encode(self, texts, batch_size=None, **kwargs):
+        import torch
+
+        if batch_size is None:
+            batch_size = self.default_batch
+
+        if self.device == 'cuda':
+            with torch.inference_mode(), \
+                 torch.autocast(device_type='cuda', dtype=torch.float16):
+                return self.model.encode(texts, batch_size=batch_size, **kwargs)
+
+        with torch.inference_mode():
+            return self.model.encode(texts, batch_size=batch_size, **kwargs)
+
+class _EmbeddingBatcher:
+    """Coalesce de queries concurrentes en un solo encode() batcheado
+
+    Las queries que llegan dentro de una ventana corta (max_wait_ms) se
+    agrupan en un único forward pass del modelo, amortizando el costo de
+    lanzamiento de kernels entre sesiones concurrentes de Streamlit.
+    """
+
+    def __init__(self, model, max_batch=32, max_wait_ms=10):
+        self.model = model
+        self.max_batch = max_batch
+        # max_wait es mutable en caliente: stats() permite ver el tamaño
+        # real de batch y ajustar la ventana si queda corta/larga
+        self.max_wait = max_wait_ms / 1000.0
+
+        # Métricas del batcher (protegidas por _stats_lock)
+        self._stats_lock = threading.Lock()
+        self._n_batches = 0
+        self._n_items = 0
+        self._max_batch_seen = 0
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def submit(self, text: str) -> Future:
+        """Encola un texto; el Future se resuelve con su embedding"""
+        fut = Future()
+        self._queue.put((text, fut))
+        return fut
+
+    def encode(self, text: str):
+        """Versión bloqueante de submit()"""
+        return self.submit(text).result()
+
+    def _worker(self):
+        while True:
+            # Bloquear hasta la primera query, luego drenar la ventana
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            with self._stats_lock:
+                self._n_batches += 1
+                self._n_items += len(batch)
+                self._max_batch_seen = max(self._max_batch_seen, len(batch))
+
+            texts = [text for text, _ in batch]
+            try:
+                embeddings = self.model.encode(
+                    texts,
+                    batch_size=self.max_batch,
+                    convert_to_numpy=True
+                )
+                for (_, fut), emb in zip(batch, embeddings):
+                    fut.set_result(emb)
+            except Exception as e:
+                for _, fut in batch:
+                    fut.set_exception(e)
+
+    def stats(self) -> Dict:
+        """Métricas acumuladas: sirven para tunear max_wait/max_batch"""
+        with self._stats_lock:
+            n_batches = self._n_batches
+            n_items = self._n_items
+            max_seen = self._max_batch_seen
+
+        return {
+            "batches": n_batches,
+            "items": n_items,
+            "avg_batch_size": round(n_items / n_batches, 2) if n_batches else 0.0,
+            "max_batch_size": max_seen,
+            "window_ms": self.max_wait * 1000.0
+        }
 
 class DociaRAG:
-    def __init__(self, persist_directory="./chroma_db"):
+    # Umbral de relevancia: candidatos con distancia >= esto no entran
+    # al prompt (misma frontera que el score 6 de _distance_to_score)
+    _RELEVANCE_CUTOFF = 0.8
+
+    # Caché de resultados: TTL y umbral coseno para tratar dos queries
+    # como "la misma pregunta reformulada"
+    _RESULT_TTL_S = 300
+    _SEMANTIC_TAU = 0.95
+    _SEMANTIC_MAX = 128
+
+    # Tuning HNSW para colecciones NUEVAS (Chroma no permite cambiarlo
+    # después de crearlas): coseno (lo que asume _distance_to_score),
+    # grafo más denso y ef más altos que los defaults conservadores
+    _HNSW_TUNING = {
+        "hnsw:space": "cosine",
+        "hnsw:M": 32,
+        "hnsw:construction_ef": 200,
+        "hnsw:search_ef": 100
+    }
+
+    def __init__(self, persist_directory="./chroma_db", use_reranker=True,
+                 embedding_precision="float32"):
         """
         Sistema RAG para Doc.ia
         - persist_directory: donde se guardan los documentos indexados
+        - use_reranker: re-rankear con cross-encoder (recall amplio -> top-N)
+        - embedding_precision: "float32" o "float16" para los embeddings
+          generados durante la ingesta (fp16 reduce a la mitad la RAM del
+          buffer de embeddings en documentos grandes)
         """
         print("🔄 Inicializando sistema RAG...")
+        self.persist_directory = persist_directory
+        self.embedding_precision = embedding_precision
         
-        # Inicializar Chroma (base de datos vectorial)
+        # Inicializar Chroma (base de datos vectorial). Import perezoso:
+        # chromadb arranca sqlite/telemetría al importarse y penaliza el
+        # cold-start de cualquier módulo que solo quiera el tipo DociaRAG
+        import chromadb
         self.client = chromadb.PersistentClient(path=persist_directory)
         
         # Modelo de embeddings local (GRATIS - corre en tu PC)
-        print("🔄 Cargando modelo de embeddings (puede tardar 1-2 min la primera vez)...")
-        self.embedding_model = SentenceTransformer('all-mpnet-base-v2')
-        print("✅ Modelo de embeddings cargado")
+        self.embedding_model = self._load_embedding_model()
         
         # Crear o cargar colección
         try:
@@ -30,19 +288,279 @@ class DociaRAG:
         except:
             self.collection = self.client.create_collection(
                 name="docia_medical_docs",
-                metadata={"description": "Documentación médica de Doc.ia"}
+                metadata={"description": "Documentación médica de Doc.ia",
+                          **self._HNSW_TUNING}
             )
             print("✅ Nueva colección creada")
+
+        # Reranker cross-encoder (carga perezosa en la primera búsqueda)
+        self.use_reranker = use_reranker
+        self._reranker = None
+
+        # Sub-colecciones por usuario (carga perezosa): buscar "solo mis
+        # documentos" consulta una colección pequeña en vez de filtrar
+        # por metadato sobre toda la colección global
+        self._user_collections = {}
+
+        # Cachés LRU para consultas repetidas: el embedding de la query
+        # (forward pass completo del transformer) y el resultado formateado.
+        # La de resultados se invalida cuando cambia el corpus.
+        self._query_emb_cache = OrderedDict()
+        self._result_cache = OrderedDict()
+        self._cache_maxsize = 512
+
+        # Nivel semántico del caché: embeddings normalizados de queries
+        # recientes + la clave de resultados que les correspondió, para
+        # servir reformulaciones casi idénticas sin tocar Chroma
+        self._sem_vecs = []
+        self._sem_keys = []
+
+        # Batcher de embeddings de query: agrupa búsquedas concurrentes
+        # en un solo forward pass del modelo
+        self._query_batcher = _EmbeddingBatcher(self.embedding_model)
+
+        # Espejo faiss HNSW de la colección global (construcción perezosa,
+        # se marca sucio cuando cambia el corpus)
+        self._faiss_index = None
+        self._faiss_ids = None
+        self._faiss_dirty = True
+
+        # Contadores para stats O(1): se pueblan con UNA pasada sobre los
+        # metadatos en la primera consulta de stats y después se mantienen
+        # incrementalmente en add_document/delete_document (None = sin poblar)
+        self._doc_id_set = None
+        self._user_chunk_counts = {}
+        self._user_doc_ids = {}
+
+        # Caché (30 s) de la lista de documentos por usuario: el dashboard
+        # la pide en cada render
+        self._user_docs_cache = {}
+
+        # Caché persistente de embeddings por hash de chunk: re-subir un
+        # PDF apenas editado solo paga el encode de los chunks nuevos
+        self._emb_cache_lock = threading.Lock()
+        self._emb_cache = self._open_emb_cache()
+
+        # Warmup: el primer encode() paga la asignación de kernels
+        # MKL/CUDA (500-1500 ms extra); pagarlo aquí y no en la primera
+        # consulta del usuario. Se loguea el tiempo para detectar
+        # regresiones de cold-start.
+        try:
+            warmup_start = time.perf_counter()
+            self.embedding_model.encode(["warmup"], batch_size=1)
+            print(f"🔥 Encoder precalentado en {time.perf_counter() - warmup_start:.2f}s")
+        except Exception as e:
+            print(f"⚠️ Warmup del encoder falló: {e}")
+
+    def _load_embedding_model(self):
+        """Carga el encoder: ONNX int8 si está configurado, PyTorch si no"""
+        onnx_path = os.getenv("DOCIA_ONNX_MODEL")
+        if onnx_path and os.path.exists(onnx_path):
+            try:
+                print("🔄 Cargando modelo de embeddings ONNX...")
+                model = _OnnxEncoder(onnx_path)
+                print("✅ Modelo ONNX cargado")
+                return model
+            except Exception as e:
+                print(f"⚠️ No se pudo cargar el modelo ONNX ({e}), usando PyTorch")
+
+        # DOCIA_USE_ONNX=1: exportar y cuantizar el encoder automáticamente
+        # (se hace una sola vez; el .onnx queda cacheado junto a la base)
+        if os.getenv("DOCIA_USE_ONNX"):
+            try:
+                model = self._build_onnx_model()
+                print("✅ Encoder ONNX int8 cargado")
+                return model
+            except Exception as e:
+                print(f"⚠️ Auto-export ONNX falló ({e}), usando PyTorch")
+
+        # Import perezoso: sentence_transformers arrastra torch (~1 s de
+        # import) que solo hace falta cuando se construye el sistema RAG
+        from sentence_transformers import SentenceTransformer
+
+        device = _detect_device()
+        print(f"🔄 Cargando modelo de embeddings en '{device}' (puede tardar 1-2 min la primera vez)...")
+        model = SentenceTransformer('all-mpnet-base-v2', device=device)
+        print("✅ Modelo de embeddings cargado")
+        return _TorchEncoder(model, device)
+
+    def _open_emb_cache(self):
+        """Abre (o crea) la tabla sqlite de embeddings cacheados en disco
+
+        Los vectores se guardan como blobs fp16 (mitad de disco; mpnet
+        tolera fp16 sin pérdida apreciable de recall). sqlite en vez de
+        LMDB: ya es la dependencia de almacenamiento de todo el proyecto.
+        """
+        try:
+            import sqlite3
+
+            os.makedirs(self.persist_directory, exist_ok=True)
+            conn = sqlite3.connect(
+                os.path.join(self.persist_directory, "emb_cache.sqlite3"),
+                check_same_thread=False
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(hash TEXT PRIMARY KEY, vec BLOB)"
+            )
+            conn.commit()
+            return conn
+        except Exception as e:
+            print(f"⚠️ Caché persistente de embeddings no disponible: {e}")
+            return None
+
+    def _emb_cache_get_many(self, hashes: List[str]) -> Dict:
+        """Devuelve {hash: embedding fp32} para los hashes ya cacheados"""
+        if self._emb_cache is None or not hashes:
+            return {}
+
+        try:
+            placeholders = ",".join("?" * len(hashes))
+            with self._emb_cache_lock:
+                rows = self._emb_cache.execute(
+                    f"SELECT hash, vec FROM embeddings WHERE hash IN ({placeholders})",
+                    hashes
+                ).fetchall()
+
+            return {h: np.frombuffer(blob, dtype=np.float16).astype(np.float32)
+                    for h, blob in rows}
+        except Exception as e:
+            print(f"⚠️ Error leyendo caché de embeddings: {e}")
+            return {}
+
+    def _emb_cache_put_many(self, items):
+        """Guarda pares (hash, embedding) como blobs fp16"""
+        if self._emb_cache is None or not items:
+            return
+
+        try:
+            with self._emb_cache_lock:
+                self._emb_cache.executemany(
+                    "INSERT OR REPLACE INTO embeddings (hash, vec) VALUES (?, ?)",
+                    [(h, np.asarray(vec, dtype=np.float16).tobytes()) for h, vec in items]
+                )
+                self._emb_cache.commit()
+        except Exception as e:
+            print(f"⚠️ Error escribiendo caché de embeddings: {e}")
+
+    def _build_onnx_model(self):
+        """Exporta mpnet a ONNX, lo cuantiza a int8 y lo cachea en disco
+
+        La exportación (optimum) y la cuantización dinámica solo corren la
+        primera vez; después se reutiliza el .onnx guardado junto a la base
+        vectorial. Int8 usa los kernels GEMM VNNI del CPU: 2-4x más
+        throughput de encode y pesos ~4x más chicos.
+        """
+        onnx_dir = os.path.join(self.persist_directory, "onnx")
+        quantized_path = os.path.join(onnx_dir, "mpnet-int8.onnx")
+
+        if not os.path.exists(quantized_path):
+            from optimum.onnxruntime import ORTModelForFeatureExtraction
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+
+            print("🔄 Exportando encoder a ONNX int8 (solo la primera vez)...")
+            exported = ORTModelForFeatureExtraction.from_pretrained(
+                _OnnxEncoder.MODEL_NAME, export=True
+            )
+            exported.save_pretrained(onnx_dir)
+
+            quantize_dynamic(
+                os.path.join(onnx_dir, "model.onnx"),
+                quantized_path,
+                weight_type=QuantType.QInt8
+            )
+
+        return _OnnxEncoder(quantized_path)
+
+    def _user_collection_name(self, user_id: str) -> str:
+        """Nombre de colección Chroma válido para un usuario"""
+        safe = re.sub(r'[^a-zA-Z0-9_-]', '_', user_id.lower())
+        return f"docia_user_{safe}"[:63]
+
+    def _get_user_collection(self, user_id: str, create: bool = False):
+        """Obtiene (o crea) la sub-colección de un usuario"""
+        name = self._user_collection_name(user_id)
+
+        collection = self._user_collections.get(name)
+        if collection is None:
+            try:
+                if create:
+                    collection = self.client.get_or_create_collection(
+                        name, metadata=dict(self._HNSW_TUNING)
+                    )
+                    # Recién creada: copiar los chunks que el usuario subió
+                    # antes de que existieran las sub-colecciones, para que
+                    # "Solo mis documentos" no pierda los documentos viejos
+                    if collection.count() == 0:
+                        self._backfill_user_collection(collection, user_id)
+                else:
+                    collection = self.client.get_collection(name)
+                self._user_collections[name] = collection
+            except Exception:
+                return None
+
+        return collection
+
+    def _backfill_user_collection(self, collection, user_id: str):
+        """Puebla una sub-colección nueva con los chunks del usuario que
+        ya estaban en la colección global (una sola vez, al crearla)"""
+        try:
+            data = self.collection.get(
+                where={"uploaded_by": user_id},
+                include=['documents', 'metadatas', 'embeddings']
+            )
+            ids = data['ids']
+            if not ids:
+                return
+
+            for start in range(0, len(ids), 1000):
+                end = start + 1000
+                collection.add(
+                    ids=ids[start:end],
+                    documents=data['documents'][start:end],
+                    embeddings=data['embeddings'][start:end],
+                    metadatas=data['metadatas'][start:end]
+                )
+
+            print(f"📦 Sub-colección de '{user_id}' poblada con "
+                  f"{len(ids)} chunks previos")
+        except Exception as e:
+            print(f"⚠️ No se pudo poblar la sub-colección de '{user_id}': {e}")
+
+    def _get_reranker(self):
+        """Carga el cross-encoder una sola vez; si falla, se desactiva"""
+        if self._reranker is None and self.use_reranker:
+            try:
+                from sentence_transformers import CrossEncoder
+                print("🔄 Cargando reranker cross-encoder...")
+                self._reranker = CrossEncoder("cross-encoder/ms-marco-MiniLM-L-6-v2")
+                print("✅ Reranker cargado")
+            except Exception as e:
+                print(f"⚠️ Reranker no disponible, se usa orden por distancia: {e}")
+                self.use_reranker = False
+        return self._reranker
     
-    def add_document(self, doc_data: Dict, metadata: Dict, uploaded_by: str = "sistema") -> str:
+    def add_document(
+        self,
+        doc_data: Dict,
+        metadata: Dict,
+        uploaded_by: str = "sistema",
+        embed_batch_size: int = 64,
+        progress_callback=None,
+        precomputed_embeddings=None
+    ) -> str:
         """
         Añade un documento completo a la base vectorial
-        
+
         Args:
             doc_data: dict con 'chunks' del DocumentProcessor
             metadata: dict con title, type, year, specialty, etc.
             uploaded_by: nombre del usuario que sube el documento
-        
+            embed_batch_size: tamaño de batch para generar embeddings
+            progress_callback: función opcional f(fraccion 0.0-1.0) para UI
+            precomputed_embeddings: array (n_chunks, dim) ya codificado
+                (lo usa bulk_add_documents para encodear en otros procesos)
+
         Returns:
             doc_id: identificador único del documento
         """
@@ -52,114 +570,608 @@ class DociaRAG:
         safe_title = metadata['title'][:30].replace(' ', '_').replace('/', '_')
         doc_id = f"{metadata.get('specialty', 'general')}_{safe_title}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
         
-        texts = []
-        metadatas = []
-        ids = []
-        
         print(f"📝 Preparando {len(chunks)} chunks para indexar...")
-        
+
+        # Campos comunes a todo el documento: un solo dict base (y un solo
+        # timestamp) en vez de reconstruir los mismos valores por chunk
+        base_meta = {
+            "doc_id": doc_id,
+            "title": metadata['title'],
+            "type": metadata.get('type', 'guideline'),
+            "specialty": metadata.get('specialty', 'cardiologia'),
+            "year": str(metadata.get('year', 2024)),
+            "upload_date": datetime.now().isoformat(),
+            "uploaded_by": uploaded_by,  # quién subió el documento
+            "content_hash": metadata.get("content_hash", "")  # hash del archivo original
+        }
+
+        # Preallocar (sin reallocs de append en documentos de 1000+ chunks)
+        texts = [None] * len(chunks)
+        metadatas = [None] * len(chunks)
+        ids = [None] * len(chunks)
+
         for i, chunk in enumerate(chunks):
-            chunk_id = f"{doc_id}_chunk_{i:04d}"
-            
-            texts.append(chunk['text'])
-            
-            metadatas.append({
-                "doc_id": doc_id,
-                "title": metadata['title'],
-                "type": metadata.get('type', 'guideline'),
-                "specialty": metadata.get('specialty', 'cardiologia'),
-                "year": str(metadata.get('year', 2024)),
+            texts[i] = chunk['text']
+            ids[i] = f"{doc_id}_chunk_{i:04d}"
+            metadatas[i] = {
+                **base_meta,
                 "page": str(chunk.get('page', 0)),
                 "section": chunk.get('section', 'Sin sección'),
-                "tokens": str(chunk.get('tokens', 0)),
-                "upload_date": datetime.now().isoformat(),
-                "uploaded_by": uploaded_by  # NUEVO: quién subió el documento
-            })
-            
-            ids.append(chunk_id)
-        
-        # Generar embeddings (vectores numéricos)
-        print(f"🔄 Generando embeddings para {len(texts)} chunks...")
-        embeddings = self.embedding_model.encode(
-            texts, 
-            show_progress_bar=True,
-            batch_size=32
-        ).tolist()
-        
-        # Añadir a Chroma en batches de 100
-        batch_size = 100
+                "tokens": str(chunk.get('tokens', 0))
+            }
+
+        # Deduplicar chunks idénticos antes de pagar sus embeddings
+        # (encabezados/pies repetidos en cada página generan copias exactas)
+        seen_hashes = set()
+        keep = []
+        for idx, text in enumerate(texts):
+            text_hash = hashlib.sha256(text.strip().lower().encode('utf-8')).hexdigest()
+            if text_hash in seen_hashes:
+                continue
+            seen_hashes.add(text_hash)
+            keep.append(idx)
+
+        n_dupes = len(texts) - len(keep)
+        if n_dupes:
+            ratio = 100.0 * n_dupes / len(texts)
+            texts = [texts[i] for i in keep]
+            metadatas = [metadatas[i] for i in keep]
+            ids = [ids[i] for i in keep]
+            print(f"♻️ Deduplicados {n_dupes} chunks idénticos "
+                  f"({ratio:.1f}% del documento, {len(texts)} únicos a indexar)")
+
+        if precomputed_embeddings is not None:
+            precomputed_embeddings = np.asarray(precomputed_embeddings, dtype=np.float32)
+            if n_dupes:
+                precomputed_embeddings = precomputed_embeddings[keep]
+
+        # PDF escaneado / solo imágenes: sin chunks no hay nada que
+        # codificar ni escribir (y el pipeline de abajo asume ≥1 batch)
+        if not texts:
+            print(f"⚠️ Documento '{metadata['title']}' sin texto extraíble; no se indexó nada")
+            return doc_id
+
+        # Pipeline embeddings/escrituras: mientras se escribe el batch k en
+        # Chroma, un hilo auxiliar ya está codificando el batch k+1. Las dos
+        # etapas se solapan (encode libera el GIL en PyTorch, la escritura
+        # es mayormente I/O de sqlite), así que el tiempo total se acerca a
+        # max(encode, write) en vez de encode + write.
+        # Batches de 1000 (Chroma admite ~5000): 10x menos BEGIN/COMMIT
+        # de sqlite que con los batches de 100 originales
+        batch_size = 1000
+        n_batches = (len(texts) - 1) // batch_size + 1
+        print(f"🔄 Generando embeddings para {len(texts)} chunks (batch={embed_batch_size})...")
         print(f"💾 Guardando en base de datos...")
-        
-        for i in range(0, len(texts), batch_size):
-            end_idx = min(i + batch_size, len(texts))
-            
+
+        emb_cache_hits = [0]
+
+        def _encode_slice(start: int, end: int):
+            slice_texts = texts[start:end]
+
+            # Embeddings ya calculados (ingesta en lote): solo hay que
+            # recortar el batch y aplicar la precisión configurada
+            if precomputed_embeddings is not None:
+                batch_embeddings = precomputed_embeddings[start:end]
+
+                if self.embedding_precision == "float16":
+                    batch_embeddings = batch_embeddings.astype(np.float16)
+
+                return batch_embeddings
+
+            # Caché persistente: solo se codifican los chunks cuyo hash
+            # no está ya en disco (re-ingestas pagan casi cero encode)
+            hashes = [hashlib.sha256(t.encode('utf-8')).hexdigest() for t in slice_texts]
+            cached = self._emb_cache_get_many(hashes)
+            miss_idx = [i for i, h in enumerate(hashes) if h not in cached]
+
+            if miss_idx:
+                encoded = self.embedding_model.encode(
+                    [slice_texts[i] for i in miss_idx],
+                    show_progress_bar=False,
+                    batch_size=embed_batch_size,
+                    convert_to_numpy=True
+                )
+                self._emb_cache_put_many(
+                    [(hashes[i], vec) for i, vec in zip(miss_idx, encoded)]
+                )
+                dim = encoded.shape[1]
+            else:
+                encoded = None
+                dim = len(next(iter(cached.values())))
+
+            emb_cache_hits[0] += len(slice_texts) - len(miss_idx)
+
+            batch_embeddings = np.empty((len(slice_texts), dim), dtype=np.float32)
+            for i, h in enumerate(hashes):
+                if h in cached:
+                    batch_embeddings[i] = cached[h]
+            if encoded is not None:
+                batch_embeddings[miss_idx] = encoded
+
+            # fp16 opcional: mitad de RAM para el buffer de embeddings
+            # (Chroma los almacena en fp32; esto reduce el pico en proceso)
+            if self.embedding_precision == "float16":
+                batch_embeddings = batch_embeddings.astype(np.float16)
+
+            # Chroma acepta ndarrays directamente: sin tolist() no se
+            # materializan ~len(batch) listas de floats de Python
+            return batch_embeddings
+
+        # Escribir también a la sub-colección del usuario
+        user_collection = self._get_user_collection(uploaded_by, create=True) if uploaded_by else None
+
+        bounds = [(i, min(i + batch_size, len(texts))) for i in range(0, len(texts), batch_size)]
+
+        def _write_batch(start: int, end: int, batch_embeddings, batch_num: int):
             self.collection.add(
-                documents=texts[i:end_idx],
-                embeddings=embeddings[i:end_idx],
-                metadatas=metadatas[i:end_idx],
-                ids=ids[i:end_idx]
+                documents=texts[start:end],
+                embeddings=batch_embeddings,
+                metadatas=metadatas[start:end],
+                ids=ids[start:end]
             )
-            
-            print(f"  ✓ Batch {i//batch_size + 1}/{(len(texts)-1)//batch_size + 1}")
-        
+
+            if user_collection is not None:
+                user_collection.add(
+                    documents=texts[start:end],
+                    embeddings=batch_embeddings,
+                    metadatas=metadatas[start:end],
+                    ids=ids[start:end]
+                )
+
+            print(f"  ✓ Batch {batch_num}/{n_batches}")
+
+        # Un hilo codifica, otro escribe: el fsync de sqlite del batch k
+        # corre en paralelo con el encode del batch k+1 (un solo writer
+        # para conservar el orden de los adds)
+        with ThreadPoolExecutor(max_workers=1) as encoder_pool, \
+             ThreadPoolExecutor(max_workers=1) as writer_pool:
+            future = encoder_pool.submit(_encode_slice, *bounds[0])
+            write_futures = []
+
+            for batch_num, (start, end) in enumerate(bounds, 1):
+                batch_embeddings = future.result()
+
+                # Pre-lanzar el encode del siguiente batch antes de escribir
+                if batch_num < n_batches:
+                    future = encoder_pool.submit(_encode_slice, *bounds[batch_num])
+
+                write_futures.append(
+                    writer_pool.submit(_write_batch, start, end, batch_embeddings, batch_num)
+                )
+
+            # Esperar las escrituras (y propagar errores) en orden
+            for batch_num, write_future in enumerate(write_futures, 1):
+                write_future.result()
+
+                if progress_callback:
+                    progress_callback(batch_num / n_batches)
+
+        if emb_cache_hits[0]:
+            print(f"♻️ {emb_cache_hits[0]}/{len(texts)} embeddings servidos desde la caché en disco")
+
+        self._user_docs_cache.clear()
+
+        # Mantener los contadores de stats al día (si ya están poblados)
+        if self._doc_id_set is not None:
+            self._doc_id_set.add(doc_id)
+            self._user_chunk_counts[uploaded_by] = \
+                self._user_chunk_counts.get(uploaded_by, 0) + len(texts)
+            self._user_doc_ids.setdefault(uploaded_by, set()).add(doc_id)
+
+        # El corpus cambió: invalidar resultados cacheados y espejo faiss
+        self._result_cache.clear()
+        self._faiss_dirty = True
+
         print(f"✅ Documento '{metadata['title']}' añadido exitosamente")
         print(f"   📊 Total: {len(chunks)} chunks indexados")
         
         return doc_id
     
+    def bulk_add_documents(
+        self,
+        documents: List,
+        uploaded_by: str = "sistema",
+        embed_batch_size: int = 64,
+        max_workers: Optional[int] = None
+    ) -> List[str]:
+        """
+        Ingesta en lote: los embeddings de cada documento se calculan en
+        procesos paralelos (un SentenceTransformer por proceso) y las
+        escrituras a Chroma quedan serializadas en este proceso, que es
+        el único writer del sqlite.
+
+        Args:
+            documents: lista de tuplas (doc_data, metadata)
+            uploaded_by: usuario que sube el lote
+            embed_batch_size: batch de encode dentro de cada worker
+            max_workers: procesos del pool (default: mitad de los cores)
+
+        Returns:
+            Lista de doc_ids en el mismo orden que documents
+        """
+        if not documents:
+            return []
+
+        from concurrent.futures import ProcessPoolExecutor
+
+        n_workers = max_workers or max((os.cpu_count() or 2) // 2, 1)
+        print(f"🚀 Ingesta en lote: {len(documents)} documentos, {n_workers} procesos...")
+
+        doc_ids = []
+
+        try:
+            with ProcessPoolExecutor(
+                max_workers=n_workers, initializer=_bulk_worker_init
+            ) as pool:
+                futures = [
+                    pool.submit(
+                        _bulk_encode_texts,
+                        [chunk['text'] for chunk in doc_data['chunks']],
+                        embed_batch_size
+                    )
+                    for doc_data, metadata in documents
+                ]
+
+                for (doc_data, metadata), future in zip(documents, futures):
+                    doc_ids.append(self.add_document(
+                        doc_data,
+                        metadata,
+                        uploaded_by=uploaded_by,
+                        embed_batch_size=embed_batch_size,
+                        precomputed_embeddings=future.result()
+                    ))
+
+        except Exception as e:
+            print(f"⚠️ Ingesta paralela falló ({e}), siguiendo en serie")
+
+            for doc_data, metadata in documents[len(doc_ids):]:
+                doc_ids.append(self.add_document(
+                    doc_data,
+                    metadata,
+                    uploaded_by=uploaded_by,
+                    embed_batch_size=embed_batch_size
+                ))
+
+        print(f"✅ Lote completo: {len(doc_ids)} documentos indexados")
+        return doc_ids
+
+    def _ensure_faiss_index(self):
+        """(Re)construye el índice HNSW desde Chroma si el corpus cambió"""
+        if not self._faiss_dirty:
+            return self._faiss_index
+
+        try:
+            data = self.collection.get(include=['embeddings'])
+            ids = data['ids']
+
+            if not ids:
+                self._faiss_index = None
+            else:
+                embeddings = np.asarray(data['embeddings'], dtype=np.float32)
+                dim = embeddings.shape[1]
+
+                # Producto interno sobre vectores normalizados == coseno,
+                # la misma métrica con la que se crean las colecciones de
+                # Chroma (hnsw:space=cosine); _faiss_search convierte la
+                # similitud a distancia coseno para que los scores de
+                # _distance_to_score sean comparables entre ambas rutas
+                norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+                embeddings = embeddings / np.clip(norms, 1e-12, None)
+
+                # HNSW con scalar quantizer int8: ~4x menos RAM que fp32
+                # (768 bytes/vector vs 3 KB) con <1% de pérdida de recall
+                # en mpnet. Si el build SQ falla, espejo Flat.
+                try:
+                    index = faiss.IndexHNSWSQ(
+                        dim, faiss.ScalarQuantizer.QT_8bit, 32,
+                        faiss.METRIC_INNER_PRODUCT
+                    )
+                    index.hnsw.efSearch = 64
+                    index.train(embeddings)
+                except Exception as e:
+                    print(f"⚠️ HNSW int8 no disponible ({e}), usando fp32")
+                    index = faiss.IndexHNSWFlat(dim, 32, faiss.METRIC_INNER_PRODUCT)
+                    index.hnsw.efSearch = 64
+
+                index.add(embeddings)
+
+                self._faiss_index = index
+                self._faiss_ids = list(ids)
+                print(f"✅ Índice faiss HNSW construido ({index.ntotal} vectores)")
+
+            self._faiss_dirty = False
+        except Exception as e:
+            print(f"⚠️ No se pudo construir el índice faiss: {e}")
+            self._faiss_index = None
+            self._faiss_dirty = False
+
+        return self._faiss_index
+
+    def _faiss_search(self, query_embedding, n_results: int):
+        """Busca en el espejo faiss; devuelve resultados con forma de Chroma
+        o None si el espejo no está disponible"""
+        if not FAISS_AVAILABLE:
+            return None
+
+        index = self._ensure_faiss_index()
+        if index is None or index.ntotal == 0:
+            return None
+
+        q = np.asarray(query_embedding, dtype=np.float32)[None, :]
+        q = q / np.clip(np.linalg.norm(q), 1e-12, None)
+        similarities, indices = index.search(q, min(n_results, index.ntotal))
+
+        ids = [self._faiss_ids[i] for i in indices[0] if i >= 0]
+        if not ids:
+            return None
+
+        # Hidratar texto y metadatos desde Chroma (get no respeta el orden)
+        data = self.collection.get(ids=ids, include=['documents', 'metadatas'])
+        by_id = {cid: (doc, meta) for cid, doc, meta
+                 in zip(data['ids'], data['documents'], data['metadatas'])}
+
+        kept, docs, metas, dists = [], [], [], []
+        for cid, sim in zip(ids, similarities[0]):
+            if cid in by_id:
+                kept.append(cid)
+                docs.append(by_id[cid][0])
+                metas.append(by_id[cid][1])
+                # Similitud coseno → distancia coseno (como Chroma)
+                dists.append(float(1.0 - sim))
+
+        return {
+            'ids': [kept],
+            'documents': [docs],
+            'metadatas': [metas],
+            'distances': [dists]
+        }
+
     def search(
-        self, 
-        query: str, 
+        self,
+        query: str,
         n_results: int = 5,
         filters: Optional[Dict] = None,
-        user_id: Optional[str] = None  # NUEVO: filtrar por usuario
+        user_id: Optional[str] = None,  # NUEVO: filtrar por usuario
+        mmr_lambda: float = 0.0,
+        fetch_k: int = 20
     ) -> List[Dict]:
         """
         Busca fragmentos relevantes en la base de datos
-        
+
         Args:
             query: pregunta del usuario
             n_results: cuántos resultados devolver (máx)
             filters: dict con filtros, ej: {"specialty": "cardiologia"}
             user_id: filtrar solo documentos de este usuario (None = todos)
-        
+            mmr_lambda: > 0 activa diversificación MMR (balance relevancia/
+                diversidad; 0.5 es un buen punto de partida). Sustituye al
+                cross-encoder en esa consulta.
+            fetch_k: tamaño del pool de candidatos para MMR
+
         Returns:
             Lista de diccionarios con los chunks más relevantes
         """
-        # Generar embedding de la query
-        query_embedding = self.embedding_model.encode(query).tolist()
-        
+        use_mmr = mmr_lambda > 0
+
+        # Hit exacto sobre resultados ya formateados
+        result_key = (query, n_results, user_id,
+                      tuple(sorted(filters.items())) if filters else None,
+                      mmr_lambda)
+        cached_results = self._cached_result(result_key)
+        if cached_results is not None:
+            self._result_cache.move_to_end(result_key)
+            return cached_results
+
+        # Generar embedding de la query (con caché LRU exacta)
+        query_embedding = self._query_emb_cache.get(query)
+        if query_embedding is not None:
+            self._query_emb_cache.move_to_end(query)
+        else:
+            query_embedding = self._query_batcher.encode(query)
+            self._query_emb_cache[query] = query_embedding
+            if len(self._query_emb_cache) > self._cache_maxsize:
+                self._query_emb_cache.popitem(last=False)
+
+        # Nivel semántico: si una query reciente casi idéntica (coseno >=
+        # 0.95) ya tiene resultados cacheados con los mismos parámetros,
+        # servirlos sin tocar Chroma ni el reranker
+        semantic_hit = self._semantic_lookup(query_embedding, result_key)
+        if semantic_hit is not None:
+            return semantic_hit
+
         # Construir filtros
         where_filter = filters.copy() if filters else {}
-        
-        # Agregar filtro de usuario si se proporciona
+
+        # Filtro de usuario: preferir su sub-colección (espacio de búsqueda
+        # podado de entrada); si no existe (datos previos a esta función),
+        # caer al filtro por metadato sobre la colección global
+        collection = self.collection
         if user_id:
-            where_filter["uploaded_by"] = user_id
-        
-        try:
-            results = self.collection.query(
-                query_embeddings=[query_embedding],
-                n_results=n_results,
-                where=where_filter if where_filter else None
-            )
-        except Exception as e:
-            print(f"⚠️ Error en búsqueda: {e}")
-            return []
-        
-        # Formatear resultados
+            user_collection = self._get_user_collection(user_id)
+            if user_collection is not None and user_collection.count() > 0:
+                collection = user_collection
+            else:
+                where_filter["uploaded_by"] = user_id
+
+        # Tamaño del pool: para MMR el fetch_k pedido; con reranker, un
+        # pool amplio del que quedarse con los mejores
+        if use_mmr:
+            pool_k = max(fetch_k, n_results)
+        else:
+            pool_k = max(n_results * 8, 40) if self.use_reranker else n_results
+
+        # Búsqueda global sin filtros: probar primero el espejo faiss
+        # (MMR necesita los embeddings de los candidatos -> siempre Chroma)
+        results = None
+        if not use_mmr and collection is self.collection and not where_filter:
+            results = self._faiss_search(query_embedding, pool_k)
+
+        if results is None:
+            try:
+                include = ['embeddings', 'documents', 'metadatas', 'distances'] \
+                    if use_mmr else None
+
+                # Vista (1, dim) del mismo buffer, sin envolver en lista
+                results = collection.query(
+                    query_embeddings=np.asarray(query_embedding)[None, :],
+                    n_results=pool_k,
+                    where=where_filter if where_filter else None,
+                    **({"include": include} if include else {})
+                )
+            except Exception as e:
+                print(f"⚠️ Error en búsqueda: {e}")
+                return []
+
+        # Diversificación MMR: elegir n_results del pool maximizando
+        # relevancia a la query y penalizando similitud con lo ya elegido
+        if use_mmr and results['ids'] and len(results['ids'][0]) > n_results:
+            pool_embs = results.get('embeddings')
+            if pool_embs is not None and pool_embs[0] is not None:
+                picked = self._mmr_select(
+                    pool_embs[0], query_embedding, mmr_lambda, n_results
+                )
+                for field in ('ids', 'documents', 'metadatas', 'distances'):
+                    row = results[field][0]
+                    results[field] = [[row[i] for i in picked]]
+
+        # Formatear resultados (scores en bloque, sin if/elif por resultado)
         formatted = []
-        
+
         if results['ids'] and len(results['ids'][0]) > 0:
-            for i in range(len(results['ids'][0])):
-                formatted.append({
-                    "chunk_id": results['ids'][0][i],
-                    "text": results['documents'][0][i],
-                    "distance": results['distances'][0][i],
-                    "metadata": results['metadatas'][0][i],
-                    "relevance_score": self._distance_to_score(results['distances'][0][i])
-                })
-        
+            ids_row = results['ids'][0]
+            docs_row = results['documents'][0]
+            dists_row = results['distances'][0]
+            metas_row = results['metadatas'][0]
+
+            distances = np.asarray(dists_row, dtype=np.float32)
+            # tolist() convierte a int nativo en bloque (sin int() por fila)
+            scores = _SCORE_VALUES[np.searchsorted(_SCORE_BINS, distances, side='right')].tolist()
+
+            formatted = [
+                {
+                    "chunk_id": chunk_id,
+                    "text": text,
+                    "distance": distance,
+                    "metadata": meta,
+                    "relevance_score": score
+                }
+                for chunk_id, text, distance, meta, score
+                in zip(ids_row, docs_row, dists_row, metas_row, scores)
+            ]
+
+        # Corte de relevancia: descartar candidatos con distancia >= umbral
+        # antes de re-rankear/formatear; cada chunk flojo que entra al prompt
+        # son tokens de prefill pagados de más. Si sobreviven menos de 2,
+        # conservar el top-2 para no perder recall en corpus chicos.
+        if formatted:
+            relevant = [r for r in formatted if r['distance'] < self._RELEVANCE_CUTOFF]
+            formatted = relevant if len(relevant) >= 2 else formatted[:2]
+
+        # Re-rankear el pool con el cross-encoder y recortar a n_results
+        if len(formatted) > n_results:
+            reranker = self._get_reranker()
+            if reranker is not None:
+                pairs = [(query, r['text']) for r in formatted]
+                scores = reranker.predict(pairs, batch_size=32)
+                order = sorted(range(len(formatted)), key=lambda i: scores[i], reverse=True)
+                formatted = [formatted[i] for i in order[:n_results]]
+            else:
+                formatted = formatted[:n_results]
+
+        self._result_cache[result_key] = (time.time(), list(formatted))
+        if len(self._result_cache) > self._cache_maxsize:
+            self._result_cache.popitem(last=False)
+
+        self._semantic_remember(query_embedding, result_key)
+
         return formatted
+
+    @staticmethod
+    def _mmr_select(candidate_embs, query_embedding, mmr_lambda: float, k: int) -> List[int]:
+        """Índices del pool elegidos por Maximal Marginal Relevance
+
+        Todas las similitudes (query-candidato y candidato-candidato) se
+        precomputan en dos matmuls; la selección iterativa solo hace un
+        argmax enmascarado por paso (~1 ms para pools de 20).
+        """
+        embs = np.asarray(candidate_embs, dtype=np.float32)
+        norms = np.linalg.norm(embs, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        embs = embs / norms
+
+        q = np.asarray(query_embedding, dtype=np.float32)
+        q_norm = np.linalg.norm(q)
+        if q_norm > 0:
+            q = q / q_norm
+
+        qsim = embs @ q
+        sim = embs @ embs.T
+
+        selected = [int(np.argmax(qsim))]
+        mask = np.ones(len(embs), dtype=bool)
+        mask[selected[0]] = False
+
+        while len(selected) < min(k, len(embs)):
+            penalty = sim[:, selected].max(axis=1)
+            mmr_score = mmr_lambda * qsim - (1.0 - mmr_lambda) * penalty
+            mmr_score[~mask] = -np.inf
+
+            best = int(np.argmax(mmr_score))
+            selected.append(best)
+            mask[best] = False
+
+        return selected
+
+    def _cached_result(self, result_key):
+        """Resultados cacheados para esta clave, o None si no hay/expiró"""
+        entry = self._result_cache.get(result_key)
+        if entry is None:
+            return None
+
+        stored_at, rows = entry
+        if time.time() - stored_at >= self._RESULT_TTL_S:
+            del self._result_cache[result_key]
+            return None
+
+        return list(rows)
+
+    def _semantic_lookup(self, query_embedding, result_key):
+        """Busca una query reciente casi idéntica con los mismos parámetros
+        de búsqueda y devuelve sus resultados cacheados (o None)"""
+        if not self._sem_vecs:
+            return None
+
+        vec = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        if norm == 0:
+            return None
+
+        sims = np.stack(self._sem_vecs) @ (vec / norm)
+        best = int(np.argmax(sims))
+
+        if sims[best] < self._SEMANTIC_TAU:
+            return None
+
+        # Solo es reutilizable si n_results/usuario/filtros coinciden
+        best_key = self._sem_keys[best]
+        if best_key[1:] != result_key[1:]:
+            return None
+
+        return self._cached_result(best_key)
+
+    def _semantic_remember(self, query_embedding, result_key):
+        """Registra la query recién resuelta en el nivel semántico"""
+        vec = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        if norm == 0:
+            return
+
+        self._sem_vecs.append(vec / norm)
+        self._sem_keys.append(result_key)
+
+        if len(self._sem_vecs) > self._SEMANTIC_MAX:
+            self._sem_vecs.pop(0)
+            self._sem_keys.pop(0)
     
     def _distance_to_score(self, distance: float) -> int:
         """
@@ -177,68 +1189,176 @@ class DociaRAG:
         else:
             return 2
     
+    def _stats_db(self):
+        """Conexión de solo lectura al sqlite interno de Chroma"""
+        import sqlite3
+
+        db_path = os.path.join(self.persist_directory, "chroma.sqlite3")
+        return sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+
+    # CTE que limita embedding_metadata a la colección global: el sqlite
+    # de Chroma es compartido por TODAS las colecciones del directorio,
+    # así que sin este filtro las sub-colecciones por usuario (que
+    # espejan cada chunk) duplicarían los agregados
+    _SCOPED_IDS_CTE = (
+        "WITH scoped AS ("
+        "    SELECT e.id"
+        "    FROM embeddings e"
+        "    JOIN segments s ON s.id = e.segment_id"
+        "    JOIN collections c ON c.id = s.collection"
+        "    WHERE c.name = 'docia_medical_docs'"
+        ") "
+    )
+
+    def _populate_counters_sql(self):
+        """Agregados directos sobre chroma.sqlite3: O(filas devueltas) en
+        Python, sin materializar un dict de metadatos por chunk"""
+        with self._stats_db() as conn:
+            doc_ids = {row[0] for row in conn.execute(
+                self._SCOPED_IDS_CTE +
+                "SELECT DISTINCT string_value FROM embedding_metadata "
+                "JOIN scoped ON scoped.id = embedding_metadata.id "
+                "WHERE key = 'doc_id'"
+            )}
+
+            user_chunks = dict(conn.execute(
+                self._SCOPED_IDS_CTE +
+                "SELECT string_value, COUNT(*) FROM embedding_metadata "
+                "JOIN scoped ON scoped.id = embedding_metadata.id "
+                "WHERE key = 'uploaded_by' GROUP BY string_value"
+            ))
+
+            user_docs = {}
+            for user, doc_id in conn.execute(
+                self._SCOPED_IDS_CTE +
+                "SELECT u.string_value, d.string_value "
+                "FROM embedding_metadata u "
+                "JOIN scoped ON scoped.id = u.id "
+                "JOIN embedding_metadata d ON d.id = u.id AND d.key = 'doc_id' "
+                "WHERE u.key = 'uploaded_by' "
+                "GROUP BY u.string_value, d.string_value"
+            ):
+                user_docs.setdefault(user, set()).add(doc_id)
+
+        return doc_ids, user_chunks, user_docs
+
+    def _ensure_stats_counters(self):
+        """Puebla los contadores de stats (agregados SQL; si el esquema
+        interno de Chroma no coincide, una pasada sobre los metadatos)"""
+        if self._doc_id_set is not None:
+            return
+
+        try:
+            doc_ids, user_chunks, user_docs = self._populate_counters_sql()
+            self._doc_id_set = doc_ids
+            self._user_chunk_counts = user_chunks
+            self._user_doc_ids = user_docs
+            return
+        except Exception as e:
+            print(f"⚠️ Agregados SQL no disponibles ({e}), escaneando metadatos")
+
+        doc_ids = set()
+        user_chunks = {}
+        user_docs = {}
+
+        try:
+            all_metadata = self.collection.get(include=['metadatas'])['metadatas'] or []
+
+            for m in all_metadata:
+                doc_id = m.get('doc_id', 'unknown')
+                user = m.get('uploaded_by', 'sistema')
+
+                doc_ids.add(doc_id)
+                user_chunks[user] = user_chunks.get(user, 0) + 1
+                user_docs.setdefault(user, set()).add(doc_id)
+        except Exception as e:
+            print(f"⚠️ Error poblando contadores de stats: {e}")
+
+        self._doc_id_set = doc_ids
+        self._user_chunk_counts = user_chunks
+        self._user_doc_ids = user_docs
+
     def get_collection_stats(self, user_id: Optional[str] = None) -> Dict:
         """
-        Estadísticas de la colección
-        
+        Estadísticas de la colección en O(1): count() de Chroma + contadores
+        mantenidos incrementalmente (sin materializar todos los metadatos)
+
         Args:
             user_id: si se proporciona, solo stats de ese usuario
         """
         count = self.collection.count()
-        
+
         if count == 0:
             return {
                 "total_chunks": 0,
                 "unique_docs": 0,
                 "by_user": {}
             }
-        
-        try:
-            all_metadata = self.collection.get()['metadatas']
-            
-            # Si hay filtro de usuario
-            if user_id:
-                user_metadata = [m for m in all_metadata if m.get('uploaded_by') == user_id]
-                unique_docs = set([m.get('doc_id', 'unknown') for m in user_metadata])
-                
-                return {
-                    "total_chunks": len(user_metadata),
-                    "unique_docs": len(unique_docs)
-                }
-            
-            # Stats generales
-            unique_docs = set([m.get('doc_id', 'unknown') for m in all_metadata])
-            
-            # Contar por usuario
-            by_user = {}
-            for m in all_metadata:
-                user = m.get('uploaded_by', 'sistema')
-                by_user[user] = by_user.get(user, 0) + 1
-            
-            return {
-                "total_chunks": count,
-                "unique_docs": len(unique_docs),
-                "by_user": by_user
-            }
-            
-        except Exception as e:
-            print(f"⚠️ Error obteniendo stats: {e}")
+
+        self._ensure_stats_counters()
+
+        # Si hay filtro de usuario
+        if user_id:
             return {
-                "total_chunks": count,
-                "unique_docs": 0,
-                "by_user": {}
+                "total_chunks": self._user_chunk_counts.get(user_id, 0),
+                "unique_docs": len(self._user_doc_ids.get(user_id, ()))
             }
+
+        # Stats generales
+        return {
+            "total_chunks": count,
+            "unique_docs": len(self._doc_id_set),
+            "by_user": dict(self._user_chunk_counts)
+        }
     
+    def has_document(self, content_hash: str) -> bool:
+        """¿Ya existe un documento con este hash de contenido?"""
+        if not content_hash:
+            return False
+
+        try:
+            results = self.collection.get(
+                where={"content_hash": content_hash},
+                limit=1
+            )
+            return bool(results['ids'])
+        except Exception as e:
+            print(f"⚠️ Error comprobando duplicado: {e}")
+            return False
+
     def delete_document(self, doc_id: str) -> bool:
         """Elimina un documento completo"""
         try:
-            # Buscar todos los chunks de ese documento
+            # Buscar todos los chunks de ese documento (solo ids y
+            # metadatos; el texto no hace falta para borrar)
             results = self.collection.get(
-                where={"doc_id": doc_id}
+                where={"doc_id": doc_id},
+                include=['metadatas']
             )
             
             if results['ids']:
                 self.collection.delete(ids=results['ids'])
+
+                # Borrar también de la sub-colección del usuario que lo subió
+                uploaded_by = results['metadatas'][0].get('uploaded_by') if results['metadatas'] else None
+                if uploaded_by:
+                    user_collection = self._get_user_collection(uploaded_by)
+                    if user_collection is not None:
+                        user_collection.delete(ids=results['ids'])
+
+                self._user_docs_cache.clear()
+
+                # Mantener los contadores de stats al día (si ya están poblados)
+                if self._doc_id_set is not None:
+                    self._doc_id_set.discard(doc_id)
+                    if uploaded_by:
+                        remaining = self._user_chunk_counts.get(uploaded_by, 0) - len(results['ids'])
+                        self._user_chunk_counts[uploaded_by] = max(remaining, 0)
+                        self._user_doc_ids.get(uploaded_by, set()).discard(doc_id)
+
+                self._result_cache.clear()
+                self._faiss_dirty = True
+
                 print(f"🗑️ Documento {doc_id} eliminado ({len(results['ids'])} chunks)")
                 return True
             else:
@@ -249,36 +1369,84 @@ class DociaRAG:
             print(f"❌ Error al eliminar: {e}")
             return False
     
+    def _get_user_documents_sql(self, user_id: str) -> List[Dict]:
+        """Lista de documentos de un usuario vía pivot SQL sobre el sqlite
+        de Chroma: una fila por documento, sin traer cada chunk a Python"""
+        query = self._SCOPED_IDS_CTE + """
+            SELECT d.string_value,
+                   MIN(t.string_value), MIN(ty.string_value),
+                   MIN(sp.string_value), MIN(y.string_value),
+                   MIN(up.string_value)
+            FROM embedding_metadata u
+            JOIN scoped ON scoped.id = u.id
+            JOIN embedding_metadata d ON d.id = u.id AND d.key = 'doc_id'
+            LEFT JOIN embedding_metadata t ON t.id = u.id AND t.key = 'title'
+            LEFT JOIN embedding_metadata ty ON ty.id = u.id AND ty.key = 'type'
+            LEFT JOIN embedding_metadata sp ON sp.id = u.id AND sp.key = 'specialty'
+            LEFT JOIN embedding_metadata y ON y.id = u.id AND y.key = 'year'
+            LEFT JOIN embedding_metadata up ON up.id = u.id AND up.key = 'upload_date'
+            WHERE u.key = 'uploaded_by' AND u.string_value = ?
+            GROUP BY d.string_value
+        """
+
+        with self._stats_db() as conn:
+            rows = conn.execute(query, (user_id,)).fetchall()
+
+        return [
+            {
+                'doc_id': doc_id,
+                'title': title or 'Sin título',
+                'type': doc_type or 'desconocido',
+                'specialty': specialty or 'general',
+                'year': year or 'N/A',
+                'upload_date': upload_date or 'N/A'
+            }
+            for doc_id, title, doc_type, specialty, year, upload_date in rows
+        ]
+
     def get_user_documents(self, user_id: str) -> List[Dict]:
         """
         Obtiene lista de documentos únicos de un usuario
-        
+        (cacheada 30 s; el dashboard la pide en cada render)
+
         Returns:
             Lista de diccionarios con info de cada documento
         """
+        cached = self._user_docs_cache.get(user_id)
+        if cached is not None and time.time() - cached[0] < 30:
+            return list(cached[1])
+
         try:
-            results = self.collection.get(
-                where={"uploaded_by": user_id}
-            )
-            
-            if not results['metadatas']:
-                return []
-            
-            # Agrupar por doc_id
-            docs = {}
-            for meta in results['metadatas']:
-                doc_id = meta.get('doc_id')
-                if doc_id and doc_id not in docs:
-                    docs[doc_id] = {
-                        'doc_id': doc_id,
-                        'title': meta.get('title', 'Sin título'),
-                        'type': meta.get('type', 'desconocido'),
-                        'specialty': meta.get('specialty', 'general'),
-                        'year': meta.get('year', 'N/A'),
-                        'upload_date': meta.get('upload_date', 'N/A')
-                    }
-            
-            return list(docs.values())
+            try:
+                docs = self._get_user_documents_sql(user_id)
+            except Exception as e:
+                print(f"⚠️ Pivot SQL no disponible ({e}), escaneando metadatos")
+
+                # Solo los chunks del usuario y solo sus metadatos (sin
+                # include, Chroma también devuelve el texto de cada chunk)
+                results = self.collection.get(
+                    where={"uploaded_by": user_id},
+                    include=['metadatas']
+                )
+
+                # Agrupar por doc_id
+                grouped = {}
+                for meta in results['metadatas'] or []:
+                    doc_id = meta.get('doc_id')
+                    if doc_id and doc_id not in grouped:
+                        grouped[doc_id] = {
+                            'doc_id': doc_id,
+                            'title': meta.get('title', 'Sin título'),
+                            'type': meta.get('type', 'desconocido'),
+                            'specialty': meta.get('specialty', 'general'),
+                            'year': meta.get('year', 'N/A'),
+                            'upload_date': meta.get('upload_date', 'N/A')
+                        }
+
+                docs = list(grouped.values())
+
+            self._user_docs_cache[user_id] = (time.time(), docs)
+            return list(docs)
             
         except Exception as e:
             print(f"⚠️ Error obteniendo documentos de usuario: {e}")
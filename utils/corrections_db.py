@@ -1,23 +1,109 @@
 # utils/corrections_db.py
 
-import json
 import os
+import sqlite3
+import threading
 from datetime import datetime
 from typing import List, Dict
 
+# orjson (parser en Rust) si está instalado; json de stdlib si no
+try:
+    import orjson
+
+    def _json_loads(raw: bytes):
+        return orjson.loads(raw)
+except ImportError:
+    import json
+
+    def _json_loads(raw: bytes):
+        return json.loads(raw)
+
 class CorrectionsDatabase:
-    """Base de datos simple para historial de correcciones"""
-    
+    """Historial de correcciones sobre sqlite con WAL
+
+    Antes era un JSON que se releía y reescribía COMPLETO en cada
+    operación (O(N) por insert). Ahora cada alta es un INSERT
+    parametrizado, los recientes salen con ORDER BY ... LIMIT y las
+    stats con GROUP BY; nada escala con el tamaño del historial. WAL
+    permite lecturas concurrentes con las escrituras (la instancia vive
+    en el cache_resource de Streamlit y se comparte entre sesiones).
+
+    El JSON legado (db_path) se migra una única vez si la tabla está
+    vacía; después solo se usa el .sqlite3 vecino.
+    """
+
     def __init__(self, db_path: str = "./corrections.json"):
         self.db_path = db_path
-        self._ensure_db_exists()
-    
-    def _ensure_db_exists(self):
-        """Crea archivo JSON si no existe"""
-        if not os.path.exists(self.db_path):
-            with open(self.db_path, 'w', encoding='utf-8') as f:
-                json.dump({"corrections": []}, f, ensure_ascii=False, indent=2)
-    
+        self.sqlite_path = os.path.splitext(db_path)[0] + ".sqlite3"
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.sqlite_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._init_schema()
+        self._migrate_from_json()
+
+    def _init_schema(self):
+        """Crea tabla e índices si no existen y activa WAL"""
+        with self._lock:
+            self._conn.executescript("""
+                PRAGMA journal_mode=WAL;
+                CREATE TABLE IF NOT EXISTS corrections (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    timestamp TEXT NOT NULL,
+                    instructor TEXT,
+                    user_level TEXT,
+                    feedback_type TEXT,
+                    question TEXT,
+                    original_response TEXT,
+                    correction TEXT
+                );
+                CREATE INDEX IF NOT EXISTS idx_corrections_timestamp
+                    ON corrections(timestamp);
+                CREATE INDEX IF NOT EXISTS idx_corrections_type
+                    ON corrections(feedback_type);
+            """)
+            self._conn.commit()
+
+    def _migrate_from_json(self):
+        """Importa el historial del JSON legado (solo si la tabla está vacía)"""
+        try:
+            with self._lock:
+                total = self._conn.execute(
+                    "SELECT COUNT(*) FROM corrections"
+                ).fetchone()[0]
+
+                if total > 0:
+                    return
+
+                # Abrir directo (sin stat previo): si el JSON no existe o
+                # desaparece entre medio, simplemente no hay nada que migrar
+                try:
+                    with open(self.db_path, 'rb') as f:
+                        data = _json_loads(f.read())
+                except FileNotFoundError:
+                    return
+
+                rows = data.get("corrections", [])
+                if not rows:
+                    return
+
+                self._conn.executemany(
+                    "INSERT INTO corrections "
+                    "(timestamp, instructor, user_level, feedback_type, "
+                    " question, original_response, correction) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(c.get("timestamp", ""), c.get("instructor", ""),
+                      c.get("user_level", ""), c.get("feedback_type", ""),
+                      c.get("question", ""), c.get("original_response", ""),
+                      c.get("correction", ""))
+                     for c in rows]
+                )
+                self._conn.commit()
+
+            print(f"📦 Migradas {len(rows)} correcciones del JSON a sqlite")
+
+        except Exception as e:
+            print(f"⚠️ No se pudo migrar el historial JSON: {e}")
+
     def add_correction(
         self,
         user_question: str,
@@ -27,70 +113,82 @@ class CorrectionsDatabase:
         user_level: str = "estudiante",
         feedback_type: str = "incorrecta"
     ) -> bool:
-        """Añade corrección al historial"""
+        """Añade corrección al historial (un INSERT, O(1))"""
         try:
-            with open(self.db_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            new_correction = {
-                "id": len(data["corrections"]) + 1,
-                "timestamp": datetime.now().isoformat(),
-                "instructor": instructor,
-                "user_level": user_level,
-                "feedback_type": feedback_type,
-                "question": user_question,
-                "original_response": original_response,
-                "correction": correction
-            }
-            
-            data["corrections"].append(new_correction)
-            
-            with open(self.db_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            
+            with self._lock:
+                self._conn.execute(
+                    "INSERT INTO corrections "
+                    "(timestamp, instructor, user_level, feedback_type, "
+                    " question, original_response, correction) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (datetime.now().isoformat(), instructor, user_level,
+                     feedback_type, user_question, original_response, correction)
+                )
+                self._conn.commit()
+
             return True
-            
+
         except Exception as e:
             print(f"Error guardando corrección: {e}")
             return False
-    
+
     def get_all_corrections(self) -> List[Dict]:
-        """Obtiene todas las correcciones"""
+        """Obtiene todas las correcciones (orden de inserción)"""
         try:
-            with open(self.db_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            return data["corrections"]
-        except:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT * FROM corrections ORDER BY id"
+                ).fetchall()
+
+            return [dict(row) for row in rows]
+
+        except Exception as e:
+            print(f"Error leyendo correcciones: {e}")
             return []
-    
+
     def get_recent_corrections(self, n: int = 10) -> List[Dict]:
-        """Obtiene N correcciones más recientes"""
-        all_corrections = self.get_all_corrections()
-        return sorted(all_corrections, key=lambda x: x["timestamp"], reverse=True)[:n]
-    
+        """Obtiene N correcciones más recientes (índice sobre timestamp)"""
+        try:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT * FROM corrections ORDER BY timestamp DESC LIMIT ?",
+                    (n,)
+                ).fetchall()
+
+            return [dict(row) for row in rows]
+
+        except Exception as e:
+            print(f"Error leyendo correcciones: {e}")
+            return []
+
     def get_stats(self) -> Dict:
-        """Estadísticas del historial"""
-        corrections = self.get_all_corrections()
-        
-        if not corrections:
+        """Estadísticas del historial (agregados en sqlite, no en Python)"""
+        try:
+            with self._lock:
+                total = self._conn.execute(
+                    "SELECT COUNT(*) FROM corrections"
+                ).fetchone()[0]
+
+                by_type = dict(self._conn.execute(
+                    "SELECT COALESCE(NULLIF(feedback_type, ''), 'desconocido'), COUNT(*) "
+                    "FROM corrections GROUP BY 1"
+                ).fetchall())
+
+                by_instructor = dict(self._conn.execute(
+                    "SELECT COALESCE(NULLIF(instructor, ''), 'desconocido'), COUNT(*) "
+                    "FROM corrections GROUP BY 1"
+                ).fetchall())
+
+            return {
+                "total": total,
+                "by_type": by_type,
+                "by_instructor": by_instructor
+            }
+
+        except Exception as e:
+            print(f"Error calculando stats: {e}")
             return {
                 "total": 0,
                 "by_type": {},
                 "by_instructor": {}
             }
-        
-        by_type = {}
-        by_instructor = {}
-        
-        for c in corrections:
-            feedback_type = c.get("feedback_type", "desconocido")
-            by_type[feedback_type] = by_type.get(feedback_type, 0) + 1
-            
-            instructor = c.get("instructor", "desconocido")
-            by_instructor[instructor] = by_instructor.get(instructor, 0) + 1
-        
-        return {
-            "total": len(corrections),
-            "by_type": by_type,
-            "by_instructor": by_instructor
-        }
\ No newline at end of file
@@ -5,54 +5,86 @@ from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
 from reportlab.lib.units import inch
 from reportlab.lib.enums import TA_CENTER
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+import html
 import io
+import os
+
+# Exporter por proceso worker del export en lote (se construye una vez
+# por proceso; funciones a nivel de módulo para que sean picklables)
+_WORKER_EXPORTER = None
+
+def _export_worker_init():
+    global _WORKER_EXPORTER
+    _WORKER_EXPORTER = ConversationPDFExporter()
+
+def _export_one(conversation: dict) -> bytes:
+    return _WORKER_EXPORTER.export_conversation(**conversation)
 
 class ConversationPDFExporter:
-    """Exporta conversaciones de Doc.ia a PDF"""
-    
+    """Exporta conversaciones de Doc.ia a PDF
+
+    Los estilos se construyen UNA vez a nivel de clase:
+    getSampleStyleSheet + los ParagraphStyle custom cuestan más que el
+    resto del armado del PDF, son idénticos para todas las instancias y
+    build() solo los lee. Los Paragraph, en cambio, se construyen por
+    export: build() los MUTA (wrap les fija width/height), así que
+    compartirlos entre hilos corrompería exports concurrentes.
+    """
+
+    _STYLES = None
+
     def __init__(self):
-        self.styles = getSampleStyleSheet()
-        self._setup_custom_styles()
-    
-    def _setup_custom_styles(self):
-        """Crea estilos personalizados"""
-        self.styles.add(ParagraphStyle(
+        self.styles = self._get_styles()
+
+    @classmethod
+    def _get_styles(cls):
+        """Hoja de estilos compartida (construcción perezosa, una vez)"""
+        if cls._STYLES is not None:
+            return cls._STYLES
+
+        styles = getSampleStyleSheet()
+
+        styles.add(ParagraphStyle(
             name='CustomTitle',
-            parent=self.styles['Heading1'],
+            parent=styles['Heading1'],
             fontSize=24,
             textColor='#1E88E5',
             spaceAfter=30,
             alignment=TA_CENTER
         ))
-        
-        self.styles.add(ParagraphStyle(
+
+        styles.add(ParagraphStyle(
             name='UserQuestion',
-            parent=self.styles['Normal'],
+            parent=styles['Normal'],
             fontSize=12,
             textColor='#424242',
             spaceAfter=10,
             leftIndent=20,
             fontName='Helvetica-Bold'
         ))
-        
-        self.styles.add(ParagraphStyle(
+
+        styles.add(ParagraphStyle(
             name='DocResponse',
-            parent=self.styles['Normal'],
+            parent=styles['Normal'],
             fontSize=11,
             textColor='#212121',
             spaceAfter=20,
             leftIndent=20,
             rightIndent=20
         ))
-        
-        self.styles.add(ParagraphStyle(
+
+        styles.add(ParagraphStyle(
             name='Metadata',
-            parent=self.styles['Normal'],
+            parent=styles['Normal'],
             fontSize=9,
             textColor='#757575',
             spaceAfter=5
         ))
+
+        cls._STYLES = styles
+        return styles
     
     def export_conversation(
         self,
@@ -62,7 +94,10 @@ class ConversationPDFExporter:
         mode: str,
         username: str = "Usuario"
     ) -> bytes:
-        """Exporta conversación a PDF"""
+        """Exporta conversación a PDF (acepta listas o generadores)"""
+        questions = list(questions)
+        responses = list(responses)
+
         buffer = io.BytesIO()
         
         doc = SimpleDocTemplate(
@@ -76,7 +111,7 @@ class ConversationPDFExporter:
         
         story = []
         
-        # Título
+        # Título (Paragraph propio de este export; ver docstring de la clase)
         story.append(Paragraph("🩺 Doc.ia - Conversación Médica", self.styles['CustomTitle']))
         story.append(Spacer(1, 0.2 * inch))
         
@@ -116,8 +151,10 @@ class ConversationPDFExporter:
             story.append(Spacer(1, 0.3 * inch))
         
         # Footer
-        footer_text = "<i>Doc.ia v1.0 | Asistente educativo - No sustituye evaluación médica profesional</i>"
-        story.append(Paragraph(footer_text, self.styles['Metadata']))
+        story.append(Paragraph(
+            "<i>Doc.ia v1.0 | Asistente educativo - No sustituye evaluación médica profesional</i>",
+            self.styles['Metadata']
+        ))
         
         doc.build(story)
         
@@ -126,9 +163,38 @@ class ConversationPDFExporter:
         
         return pdf_bytes
     
+    def export_conversations_bulk(self, conversations: list, max_workers: int = None) -> list:
+        """Exporta varias conversaciones en paralelo (un PDF por proceso)
+
+        Args:
+            conversations: lista de dicts con los kwargs de
+                export_conversation (questions, responses, user_level,
+                mode, username)
+            max_workers: procesos del pool (default: cores disponibles)
+
+        Returns:
+            Lista de bytes de PDF, en el mismo orden que conversations
+        """
+        if not conversations:
+            return []
+
+        # Con una sola conversación no vale la pena levantar procesos
+        if len(conversations) == 1:
+            return [self.export_conversation(**conversations[0])]
+
+        n_workers = min(max_workers or os.cpu_count() or 1, len(conversations))
+
+        try:
+            with ProcessPoolExecutor(
+                max_workers=n_workers, initializer=_export_worker_init
+            ) as pool:
+                # map preserva el orden de entrada
+                return list(pool.map(_export_one, conversations))
+        except Exception as e:
+            print(f"⚠️ Export paralelo falló ({e}), exportando en serie")
+            return [self.export_conversation(**c) for c in conversations]
+
     def _clean_text(self, text: str) -> str:
-        """Limpia texto para PDF"""
-        text = text.replace('&', '&amp;')
-        text = text.replace('<', '&lt;')
-        text = text.replace('>', '&gt;')
-        return text
\ No newline at end of file
+        """Limpia texto para PDF (escape en una pasada C, sin copias
+        intermedias por cada replace)"""
+        return html.escape(text, quote=False)
\ No newline at end of file